@@ -0,0 +1,64 @@
+"""Least recently used cache of hot document data, bounded in bytes
+
+Entries are keyed by a document name and a version of its data, so a
+document replaced behind the cache's back is never served stale; all
+entries of a document are dropped when it is stored again or deleted.
+"""
+from collections import OrderedDict
+
+# No single entry may take more than this share of the budget
+ENTRY_SHARE = 4
+
+
+class ByteCache:
+    """Keeps bytes or arrays until ``budget`` bytes are used, then drops the least recently used"""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, str], object] = OrderedDict()
+
+    def fits(self, size: int) -> bool:
+        return size <= self.budget // ENTRY_SHARE
+
+    def get(self, name: str, version: str):
+        value = self._entries.get((name, version))
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((name, version))
+        self.hits += 1
+        return value
+
+    def put(self, name: str, version: str, value):
+        size = memoryview(value).nbytes
+        if not self.fits(size):
+            return
+        self._drop((name, version))
+        self._entries[name, version] = value
+        self.used += size
+        while self.used > self.budget:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: tuple[str, str]):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self.used -= memoryview(value).nbytes
+
+    def discard(self, name: str):
+        """Drop every entry of a document"""
+        for key in [key for key in self._entries if key[0] == name]:
+            self._drop(key)
+
+    def summary(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "budget": self.budget,
+            "used": self.used,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,133 @@
+"""Content-defined chunking
+
+Chunk boundaries are picked after a line whose CRC satisfies a size-scaled
+condition, so they depend only on nearby content: editing a few lines changes
+the chunks around the edit, the rest of the document keeps its chunks and is
+stored once. Cutting on line ends also keeps lines whole inside a chunk unless
+a single line is longer than ``MAX_SIZE``.
+
+``WebApp/chunking.py`` must produce the same boundaries for uploads to skip
+chunks that nodes already hold.
+"""
+import hashlib
+import zlib
+from bisect import bisect_right
+from itertools import accumulate
+
+MIN_SIZE = 16 * 1024
+AVERAGE_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class Chunker:
+    """Splits a stream fed piece by piece into content-defined chunks"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    def _cut(self, size: int) -> bytes:
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._scanned = max(self._scanned - size, 0)
+        return chunk
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """Add data, returns the chunks it completed"""
+        self._buffer += data
+        chunks = []
+        while True:
+            newline = self._buffer.find(b"\n", self._scanned)
+            end = newline + 1
+            if newline < 0 or end > MAX_SIZE:
+                if len(self._buffer) < MAX_SIZE:
+                    break
+                # No line end fits: cut before the long line or inside it
+                chunks.append(self._cut(self._scanned if self._scanned >= MIN_SIZE else MAX_SIZE))
+                continue
+            line = self._buffer[self._scanned:end]
+            self._scanned = end
+            if end >= MIN_SIZE and zlib.crc32(line) % AVERAGE_SIZE < len(line):
+                chunks.append(self._cut(end))
+        return chunks
+
+    def finish(self) -> list[bytes]:
+        """The remaining data as the last chunk"""
+        return [self._cut(len(self._buffer))] if self._buffer else []
+
+
+class ChunkedView:
+    """Read-only view of a chunked document
+
+    Offers the part of the mmap interface used by search: ``len``, slicing,
+    ``find`` and sequential ``readline``.
+    """
+
+    def __init__(self, manifest: list[tuple[str, int]], load):
+        self._digests = [chunk_digest for chunk_digest, _ in manifest]
+        self._starts = list(accumulate((size for _, size in manifest), initial=0))
+        self._load = load
+        self._cache: dict[int, bytes] = {}
+        self._position = 0
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def _chunk(self, index: int) -> bytes:
+        if index not in self._cache:
+            if len(self._cache) >= 2:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[index] = self._load(self._digests[index])
+        return self._cache[index]
+
+    def _locate(self, position: int) -> int:
+        return bisect_right(self._starts, position) - 1
+
+    def __getitem__(self, key: slice) -> bytes:
+        start, stop, _ = key.indices(len(self))
+        parts = []
+        index = self._locate(start)
+        while start < stop:
+            chunk_start = self._starts[index]
+            part = self._chunk(index)[start - chunk_start:stop - chunk_start]
+            parts.append(part)
+            start += len(part)
+            index += 1
+        return b"".join(parts)
+
+    def find(self, sub: bytes, start: int = 0, end: int | None = None) -> int:
+        end = len(self) if end is None else min(end, len(self))
+        start = max(start, 0)
+        if not sub:
+            return start if start <= end else -1
+        index = self._locate(start)
+        while index < len(self._digests) and self._starts[index] < end:
+            chunk_start, boundary = self._starts[index], self._starts[index + 1]
+            found = self._chunk(index).find(sub, max(start - chunk_start, 0), end - chunk_start)
+            if found >= 0:
+                return chunk_start + found
+            if boundary < end and len(sub) > 1:
+                # Matches crossing into the next chunk
+                left = max(boundary - len(sub) + 1, start)
+                found = self[left:min(boundary + len(sub) - 1, end)].find(sub)
+                if found >= 0:
+                    return left + found
+            index += 1
+        return -1
+
+    def seek(self, position: int):
+        self._position = position
+
+    def tell(self) -> int:
+        return self._position
+
+    def readline(self) -> bytes:
+        newline = self.find(b"\n", self._position)
+        end = len(self) if newline < 0 else newline + 1
+        line = self[self._position:end]
+        self._position = end
+        return line
@@ -0,0 +1,53 @@
+"""Delta transfer of edited documents
+
+A node describes its version of a document by block signatures: a weak rolling
+checksum and a strong hash of every ``block_size`` bytes, the last block may be
+shorter. The client looks for these blocks at any offset of the new version and
+sends a delta of instructions (big-endian)::
+
+    b"C" | block index (u32)      copy a block of the stored version
+    b"L" | length (u32) | bytes    literal data
+    b"E" | sha256 (32 bytes)       end, digest of the new version
+
+``WebApp/delta.py`` must compute the checksums the same way.
+"""
+import hashlib
+import math
+import struct
+from contextlib import ExitStack
+from itertools import accumulate
+
+import store
+
+U32 = struct.Struct("!I")
+COPY, LITERAL, END = b"C", b"L", b"E"
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 64 * 1024
+MODULUS = 1 << 16
+
+
+def block_size(size: int) -> int:
+    """Square root of the size keeps both signature and delta small"""
+    return min(max(math.isqrt(size), MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def weak_checksum(block: bytes) -> int:
+    a = sum(block) % MODULUS
+    b = sum(accumulate(block)) % MODULUS
+    return a | b << 16
+
+
+def strong_hash(block: bytes) -> str:
+    return hashlib.sha256(block).hexdigest()[:32]
+
+
+def signatures(name: str) -> dict:
+    """Size, block size and block signatures of a stored document, no blocks if it is missing"""
+    if not store.exists(name):
+        return {"size": 0, "block_size": MIN_BLOCK_SIZE, "blocks": []}
+    with ExitStack() as stack:
+        view = store.open_view(stack, name)
+        size = block_size(len(view))
+        blocks = [(weak_checksum(block), strong_hash(block))
+                  for block in (view[start:start + size] for start in range(0, len(view), size))]
+        return {"size": len(view), "block_size": size, "blocks": blocks}
@@ -0,0 +1,63 @@
+"""Grouped fsync
+
+A write is acknowledged only once it reached the disk, but an fsync per file
+would queue concurrent uploads behind each other. Paths to sync join the
+group that is about to start, one worker thread syncs the whole group while
+the next one gathers.
+"""
+import asyncio
+import os
+
+
+def _fsync(paths: set[str]):
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class SyncGroup:
+    """Batches fsyncs of files and directories
+
+    :param enabled: when False, ``sync`` returns at once, data then reaches the
+        disk whenever the OS writes it back
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.groups = 0
+        self.paths = 0
+        self._next: tuple[set[str], asyncio.Future] | None = None
+        self._runner: asyncio.Task | None = None
+
+    async def sync(self, paths):
+        """Return once all ``paths`` are on disk"""
+        paths = set(paths)
+        if not self.enabled or not paths:
+            return
+        if self._next is None:
+            self._next = set(), asyncio.get_running_loop().create_future()
+        group, done = self._next
+        group.update(paths)
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+        await asyncio.shield(done)
+
+    async def _run(self):
+        while self._next is not None:
+            group, done = self._next
+            self._next = None
+            try:
+                await asyncio.to_thread(_fsync, group)
+            except OSError as er:
+                done.set_exception(er)
+            else:
+                done.set_result(None)
+            self.groups += 1
+            self.paths += len(group)
+        self._runner = None
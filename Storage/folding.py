@@ -0,0 +1,37 @@
+"""Casefolded shadow of a document
+
+Case-insensitive search runs over a copy of the document in which every
+character is replaced by its Unicode case folding, so the query is folded once
+instead of every line on every search. Folding may change the length of a
+line ("ß" becomes "ss"), so the shadow keeps line offsets of its own; line
+``n`` of the shadow is line ``n`` of the document.
+"""
+import codecs
+
+import offsets
+
+
+def fold(text: str) -> bytes:
+    return text.casefold().encode()
+
+
+class ShadowBuilder:
+    """Writes the shadow and its line offsets while the document is read chunk by chunk"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "wb")
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.offsets = offsets.OffsetsBuilder()
+
+    def feed(self, data: bytes):
+        self._write(self._decoder.decode(data))
+
+    def _write(self, text: str):
+        folded = fold(text)
+        self._file.write(folded)
+        self.offsets.feed(folded)
+
+    def dump(self, offsets_path: str):
+        self._write(self._decoder.decode(b"", final=True))
+        self._file.close()
+        self.offsets.dump(offsets_path)
@@ -0,0 +1,51 @@
+"""Hash tree over the checksums of all documents of a node
+
+Leaves are (name, SHA-256 of the document) pairs, spread over ``FANOUT``
+buckets by a hash of the name; a bucket hash covers its sorted leaves and the
+root hash covers all bucket hashes. Two nodes holding the same documents have
+the same root, otherwise only the leaves of buckets with different hashes
+have to be compared.
+"""
+import hashlib
+
+FANOUT = 256
+
+
+def bucket_of(name: str) -> int:
+    return hashlib.sha256(name.encode()).digest()[0] % FANOUT
+
+
+class MerkleTree:
+    def __init__(self, checksums: dict[str, str] = None):
+        self.buckets: list[dict[str, str]] = [{} for _ in range(FANOUT)]
+        self._hashes: list[str | None] = [None] * FANOUT
+        for name, checksum in (checksums or {}).items():
+            self.set(name, checksum)
+
+    def set(self, name: str, checksum: str):
+        bucket = bucket_of(name)
+        self.buckets[bucket][name] = checksum
+        self._hashes[bucket] = None
+
+    def discard(self, name: str):
+        bucket = bucket_of(name)
+        if self.buckets[bucket].pop(name, None) is not None:
+            self._hashes[bucket] = None
+
+    def bucket_hash(self, bucket: int) -> str:
+        if self._hashes[bucket] is None:
+            hasher = hashlib.sha256()
+            for name, checksum in sorted(self.buckets[bucket].items()):
+                hasher.update(f"{name}\0{checksum}\n".encode())
+            self._hashes[bucket] = hasher.hexdigest()
+        return self._hashes[bucket]
+
+    def bucket_hashes(self) -> list[str]:
+        return [self.bucket_hash(bucket) for bucket in range(FANOUT)]
+
+    def root(self) -> str:
+        return hashlib.sha256("".join(self.bucket_hashes()).encode()).hexdigest()
+
+    def differing(self, bucket_hashes: list[str]) -> list[int]:
+        """Buckets whose hash differs from the other tree's"""
+        return [bucket for bucket, other in enumerate(bucket_hashes) if self.bucket_hash(bucket) != other]
@@ -0,0 +1,47 @@
+"""Line-offset sidecars
+
+A sidecar is a flat array of unsigned 64-bit integers: the byte offset at which
+every line of the stored file starts. Line ``n`` (1-based) starts at entry
+``n - 1`` and ends where entry ``n`` begins, so any line range can be located
+with two small reads instead of rescanning the file prefix.
+"""
+from array import array
+
+
+class OffsetsBuilder:
+    """Collects line starts while a file is written chunk by chunk"""
+
+    def __init__(self):
+        self.offsets = array("Q", [0])
+        self._position = 0
+
+    def feed(self, data: bytes):
+        offsets, position, find = self.offsets, self._position, data.find
+        i = find(b"\n")
+        while i >= 0:
+            offsets.append(position + i + 1)
+            i = find(b"\n", i + 1)
+        self._position += len(data)
+
+    def dump(self, path: str):
+        with open(path, "wb") as file:
+            self.offsets.tofile(file)
+
+
+def load(index_path: str) -> array:
+    line_offsets = array("Q")
+    with open(index_path, "rb") as file:
+        line_offsets.frombytes(file.read())
+    return line_offsets
+
+
+def span(line_offsets: array, start: int, stop: int) -> tuple[int | None, int | None]:
+    """Byte range covering lines ``start``..``stop`` (1-based, inclusive)
+
+    :param line_offsets: offsets read with ``load``
+    :return: offset of the first byte of ``start`` and the offset right after
+        ``stop``; ``None`` means the line lies past the end of the file
+    """
+    start, count = max(start, 1) - 1, len(line_offsets)
+    return line_offsets[start] if start < count else None, line_offsets[stop] if stop < count else None
+
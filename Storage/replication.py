@@ -0,0 +1,86 @@
+"""Bookkeeping of copies to other nodes
+
+A copy appends every document it delivered to a checkpoint file
+``root/.replication/<host>_<port>``, together with the version of the document
+it sent. If the copy is interrupted, it resumes from the checkpoint and skips
+documents that did not change since. The checkpoint is removed once
+everything is copied.
+"""
+import asyncio
+import json
+import os
+
+import store
+
+
+class Throttle:
+    """Token bucket shared by all transfers of a copy
+
+    :param rate: bytes per second, ``None`` means unlimited
+    """
+
+    def __init__(self, rate: int | None):
+        self.rate = rate
+        self.sent = 0
+        self._tokens = 0.0
+        self._updated = None
+
+    async def consume(self, count: int):
+        """Account ``count`` bytes about to be sent, waits while over the rate"""
+        self.sent += count
+        if not self.rate:
+            return
+        now = asyncio.get_running_loop().time()
+        if self._updated is not None:
+            # Allow bursts of at most one second worth of data
+            self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.rate)
+        self._updated = now
+        self._tokens -= count
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class Checkpoint:
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self.path = os.path.join(store.REPLICATION_DIR, f"{host}_{port}")
+
+    def load(self) -> dict[str, str]:
+        """Versions of the documents already copied"""
+        done = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                next(file)
+                for line in file:
+                    try:
+                        name, version = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut by a crash
+                    done[name] = version
+        except (FileNotFoundError, StopIteration):
+            with open(self.path, "w", encoding="utf-8") as file:
+                file.write(json.dumps({"host": self.host, "port": self.port}) + "\n")
+        return done
+
+    def record(self, name: str, version: str):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps([name, version]) + "\n")
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def pending() -> list[tuple[str, int]]:
+    """Targets of copies that were interrupted"""
+    targets = []
+    for filename in os.listdir(store.REPLICATION_DIR):
+        with open(os.path.join(store.REPLICATION_DIR, filename), "r", encoding="utf-8") as file:
+            try:
+                target = json.loads(file.readline())
+            except ValueError:
+                continue
+        targets.append((target["host"], target["port"]))
+    return targets
@@ -0,0 +1,291 @@
+"""Substring search over a line range of a stored document
+
+The document and its line-offset sidecar are accessed in place (memory-mapped
+or through the chunk store); the pattern is located with ``find`` and line
+numbers are recovered by bisecting the offsets only where a hit lands, so no
+per-line objects are created. Case-insensitive searches run the same way over
+the casefolded shadow of the document (see ``folding``).
+"""
+import hashlib
+import mmap
+import os
+import re
+import signal
+from bisect import bisect_right
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+
+import folding
+import offsets
+import store
+import trigrams
+
+# Every candidate line costs a separate find, so when the index leaves more
+# than one line in CANDIDATE_SHARE a single pass over the range is cheaper.
+CANDIDATE_SHARE = 8
+# Compiled regular expressions kept by each worker
+PATTERN_CACHE_SIZE = 256
+
+
+def _line_starts(stack: ExitStack, name: str, kind: str = "offsets") -> memoryview:
+    file = stack.enter_context(open(store.sidecar(name, kind), "rb"))
+    index = stack.enter_context(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    line_starts = memoryview(index).cast("Q")
+    stack.callback(line_starts.release)
+    return line_starts
+
+
+def _line_start(line_starts, number: int, size: int) -> int:
+    """Offset of line ``number`` (1-based), document size past the last line"""
+    return line_starts[number - 1] if number <= len(line_starts) else size
+
+
+def _open_shadow(stack: ExitStack, name: str):
+    file = stack.enter_context(open(store.sidecar(name, "folded"), "rb"))
+    if os.fstat(file.fileno()).st_size == 0:
+        return b""
+    return stack.enter_context(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _is_word(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def _whole_word(data, start: int, end: int) -> bool:
+    """True if the match at ``start``..``end`` has no letter, digit or "_" right before or after it"""
+    before = data[max(start - 4, 0):start].decode("utf-8", errors="ignore")[-1:]
+    after = data[end:end + 4].decode("utf-8", errors="ignore")[:1]
+    return not (before and _is_word(before) or after and _is_word(after))
+
+
+def _find(data, pattern: bytes, start: int, end: int, whole_word: bool) -> int:
+    position = data.find(pattern, start, end)
+    while whole_word and position >= 0 and not _whole_word(data, position, position + len(pattern)):
+        position = data.find(pattern, position + 1, end)
+    return position
+
+
+def scan(data, line_starts, pattern: bytes, start: int, stop: int, whole_word: bool = False,
+         limit: int | None = None) -> list[int]:
+    size = len(data)
+    position, end = _line_start(line_starts, start, size), _line_start(line_starts, stop + 1, size)
+    found = []
+    while (position := _find(data, pattern, position, end, whole_word)) >= 0:
+        number = bisect_right(line_starts, position)
+        found.append(number)
+        if len(found) == limit:
+            break
+        position = _line_start(line_starts, number + 1, size)
+        if position >= end:
+            break
+    return found
+
+
+def check(data, line_starts, pattern: bytes, numbers: list[int], whole_word: bool = False,
+          limit: int | None = None) -> list[int]:
+    size = len(data)
+    found = []
+    for number in numbers:
+        if _find(data, pattern, _line_start(line_starts, number, size),
+                 _line_start(line_starts, number + 1, size), whole_word) >= 0:
+            found.append(number)
+            if len(found) == limit:
+                break
+    return found
+
+
+def _temporary_sidecars(name: str, *kinds: str) -> dict[str, tuple[str, str]]:
+    return {kind: (store.temporary_path(store.sidecar(name, kind)), store.sidecar(name, kind)) for kind in kinds}
+
+
+def index_offsets(name: str):
+    """Build the offsets sidecar of a document stored before offsets were kept"""
+    line_offsets = offsets.OffsetsBuilder()
+    for data in store.iter_bytes(name):
+        line_offsets.feed(data)
+    renames = _temporary_sidecars(name, "offsets")
+    try:
+        line_offsets.dump(renames["offsets"][0])
+        store.publish(list(renames.values()))
+    finally:
+        store.discard(list(renames.values()))
+
+
+def index_folded(name: str):
+    """Build the casefolded shadow of a document stored before shadows were kept"""
+    renames = _temporary_sidecars(name, "folded", "folded_offsets")
+    try:
+        shadow = folding.ShadowBuilder(renames["folded"][0])
+        for data in store.iter_bytes(name):
+            shadow.feed(data)
+        shadow.dump(renames["folded_offsets"][0])
+        store.publish(list(renames.values()))
+    finally:
+        store.discard(list(renames.values()))
+
+
+def index_file(name: str, trigram_limit: int, path: str | None = None) -> tuple[list[tuple[str, str]], bool]:
+    """Build the line offsets, the trigram index, the casefolded shadow and the checksum of a document in one pass
+
+    The sidecars are written to temporary files, to be published with the
+    version of the document they describe.
+
+    :param path: plain file or manifest of a version not published yet
+    :return: renames of the sidecars, see ``store.publish``, and False if the
+        document is larger than ``trigram_limit`` and got no trigram index
+    """
+    # The version goes first, see store.drop_stale_sidecars
+    renames = _temporary_sidecars(name, "version", "offsets", "trigrams", "folded", "folded_offsets", "sha256")
+    try:
+        with open(renames["version"][0], "w", encoding="ascii") as file:
+            file.write(store.file_version(path or store.layout_path(name)))
+        line_offsets, trigram_index = offsets.OffsetsBuilder(), trigrams.TrigramBuilder(trigram_limit)
+        shadow = folding.ShadowBuilder(renames["folded"][0])
+        hasher = hashlib.sha256()
+        for data in store.iter_bytes(name, path=path):
+            line_offsets.feed(data)
+            trigram_index.feed(data)
+            shadow.feed(data)
+            hasher.update(data)
+        line_offsets.dump(renames["offsets"][0])
+        shadow.dump(renames["folded_offsets"][0])
+        with open(renames["sha256"][0], "w", encoding="ascii") as file:
+            file.write(hasher.hexdigest())
+        if not trigram_index.dump(renames["trigrams"][0]):
+            del renames["trigrams"]
+            return list(renames.values()), False
+        return list(renames.values()), True
+    except BaseException:
+        store.discard(list(renames.values()))
+        raise
+
+
+def find_lines(name: str, pattern: bytes, start: int, stop: int,
+               ignore_case: bool = False, whole_word: bool = False, limit: int | None = None) -> list[int]:
+    """Numbers of lines in ``start``..``stop`` (1-based, inclusive) containing ``pattern``
+
+    :param ignore_case: search the casefolded shadow for the folded pattern
+    :param whole_word: skip matches preceded or followed by a letter, digit or "_"
+    :param limit: stop after this many lines, the first ones of the range
+    """
+    if b"\n" in pattern[:-1]:
+        return []
+    with ExitStack() as stack:
+        if ignore_case:
+            data = _open_shadow(stack, name)
+            pattern = folding.fold(pattern.decode("utf-8", errors="replace"))
+        else:
+            data = store.open_view(stack, name)
+        if not len(data):
+            return []
+        line_starts = _line_starts(stack, name, "folded_offsets" if ignore_case else "offsets")
+
+        trigrams_path = store.sidecar(name, "trigrams")
+        # Indexed lines are split on line ends, a trailing one is only checked on the candidates
+        key = pattern.removesuffix(b"\n")
+        if not ignore_case and len(key) >= 3 and os.path.exists(trigrams_path):
+            numbers = trigrams.candidates(trigrams_path, key, start, stop)
+            if len(numbers) * CANDIDATE_SHARE < stop - start + 1:
+                return check(data, line_starts, pattern, numbers, whole_word, limit)
+        return scan(data, line_starts, pattern, start, stop, whole_word, limit)
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern: str, ignore_case: bool = False, whole_word: bool = False) -> re.Pattern:
+    if whole_word:
+        pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+    return re.compile(pattern, re.MULTILINE | (re.IGNORECASE if ignore_case else 0))
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Raise TimeoutError in the block once it runs longer than ``seconds``
+
+    The regex engine checks for signals while it backtracks, so even a single
+    catastrophic match is cut off. Only usable in the main thread of a worker.
+    """
+    def expire(signum, frame):
+        raise TimeoutError(f"Search took longer than {seconds} s")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def find_regex(name: str, pattern: str, start: int, stop: int, budget: float,
+               ignore_case: bool = False, whole_word: bool = False, limit: int | None = None) -> list[int]:
+    """Numbers of lines in ``start``..``stop`` with a match of the regular expression ``pattern``
+
+    The range is decoded as UTF-8 so classes like ``\\w`` cover all letters,
+    ``^`` and ``$`` match at line ends and a match is reported on the line it
+    starts on. Raises ``re.error`` for an invalid pattern and TimeoutError once
+    the search runs longer than ``budget`` seconds. ``ignore_case``,
+    ``whole_word`` and ``limit`` act as in ``find_lines``.
+    """
+    compiled = compile_pattern(pattern, ignore_case, whole_word)
+    with ExitStack() as stack, deadline(budget):
+        data = store.open_view(stack, name)
+        if not len(data):
+            return []
+        line_starts = _line_starts(stack, name)
+        size = len(data)
+        text = data[_line_start(line_starts, start, size):_line_start(line_starts, stop + 1, size)]
+        text = text.decode("utf-8", errors="replace")
+
+        found = []
+        number, position = start, 0
+        while match := compiled.search(text, position):
+            number += text.count("\n", position, match.start())
+            if number > stop:
+                break
+            found.append(number)
+            position = text.find("\n", match.start()) + 1
+            if not position or len(found) == limit:
+                break
+            number += 1
+        return found
+
+
+def _snippet(line: str, match: re.Match | None, width: int) -> str:
+    if len(line) <= width:
+        return line
+    begin, end = match.span() if match else (0, 0)
+    begin = max(min(begin - max(width - (end - begin), 0) // 2, len(line) - width), 0)
+    return ("…" if begin else "") + line[begin:begin + width] + ("…" if begin + width < len(line) else "")
+
+
+def snippets(name: str, numbers: list[int], pattern: str, width: int, budget: float, regex: bool = False,
+             ignore_case: bool = False, whole_word: bool = False) -> list[tuple[int, str]]:
+    """Text of lines ``numbers``, longer lines cut to ``width`` characters around the first match
+
+    The options are those of the search that found the lines.
+    """
+    compiled = compile_pattern(pattern if regex else re.escape(pattern), ignore_case, whole_word)
+    found = []
+    with ExitStack() as stack, deadline(budget):
+        data = store.open_view(stack, name)
+        line_starts = _line_starts(stack, name)
+        size = len(data)
+        for number in numbers:
+            line = data[_line_start(line_starts, number, size):_line_start(line_starts, number + 1, size)]
+            line = line.decode("utf-8", errors="replace").removesuffix("\n").removesuffix("\r")
+            found.append((number, _snippet(line, compiled.search(line), width)))
+    return found
+
+
+def find_many(name: str, patterns: list[bytes], start: int, stop: int) -> list[list[int]]:
+    """Lines in ``start``..``stop`` containing each of ``patterns``
+
+    Every pattern is located with ``find`` as in ``scan``: a pass of C-speed
+    search per pattern beats a single pass that looks at every byte in Python.
+    """
+    with ExitStack() as stack:
+        data = store.open_view(stack, name)
+        if not len(data):
+            return [[] for _ in patterns]
+        line_starts = _line_starts(stack, name)
+        return [scan(data, line_starts, pattern, start, stop) for pattern in patterns]
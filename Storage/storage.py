@@ -1,56 +1,735 @@
 import asyncio
-import itertools
+import hashlib
+import json
 import os.path
+import re
 import shutil
+import struct
+from collections import Counter, deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from logging import basicConfig, INFO, StreamHandler, warning
 from logging import info
 from shutil import rmtree
 
 from yaml import safe_load
 
+import cache
+import chunks
+import delta
+import durability
+import merkle
+import offsets
+import replication
+import search
+import stats
+import store
+
+# Chunks referenced by uploads in progress, the collector must keep them
+PINNED = Counter()
+KEEP: set[str] | None = None
+GC_DELAY = 30
+gc_handle = None
+
+# Copies to other nodes in progress by target
+REPLICATIONS: dict[tuple[str, int], asyncio.Task] = {}
+REPLICATION_RETRIES = 3
+PROGRESS_INTERVAL = 5
+
+STATS = stats.Stats()
+
+# Lines whose snippets one worker call reads before they are sent
+SNIPPET_BATCH = 1000
+
+# Loaded on first use, names changed while it loads are applied afterwards
+TREE: merkle.MerkleTree | None = None
+TREE_CHANGES: set[str] | None = None
+TREE_LOCK = asyncio.Lock()
+
+
+# Multiplexed protocol: after a "Mux#" command every message is a frame
+# (request id, frame type, payload length) followed by the payload.
+FRAME_HEADER = struct.Struct("!IBI")
+CALL, DATA, EOF, CLOSE = range(4)
+# Read-only commands a CLOSE from the client stops before they are done
+CANCELLABLE = {"Find", "FindMany"}
+FRAME_SIZE = 64 * 1024
+# Messages of any size, e.g. chunk manifests, are preceded by their length
+LENGTH = struct.Struct("!I")
+SENDFILE_SIZE = 1024 * 1024
+# Received data is written to disk in pieces of this size
+WRITE_SIZE = 1024 * 1024
+
+
+class FrameReader:
+    """Arguments and body of one multiplexed request.
+
+    Mimics the part of asyncio.StreamReader used by the command handlers.
+    """
+
+    def __init__(self, args: list[str]):
+        self.args = deque(args)
+        self._chunks = asyncio.Queue(maxsize=16)
+        self._buffer = bytearray()
+        self._eof = False
+        self._discarded = False
+        self.received = 0
+
+    async def feed(self, data: bytes):
+        """Pass a body chunk to the handler, empty bytes mean end of body"""
+        self.received += len(data)
+        if not self._discarded:
+            await self._chunks.put(data)
+
+    def discard(self):
+        """Drop the unread body so the demultiplexer never blocks on it"""
+        self._discarded = True
+        while not self._chunks.empty():
+            self._chunks.get_nowait()
+
+    def abort(self):
+        """Wake up the handler after the connection was lost"""
+        self.discard()
+        self._chunks.put_nowait(None)
+
+    async def _fill(self):
+        chunk = await self._chunks.get()
+        if chunk is None:
+            raise ConnectionResetError("Connection lost")
+        if chunk:
+            self._buffer += chunk
+        else:
+            self._eof = True
+
+    async def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            while not self._eof:
+                await self._fill()
+            n = len(self._buffer)
+        elif not self._buffer and not self._eof:
+            await self._fill()
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readuntil(self, separator: bytes = b"\n") -> bytes:
+        while (position := self._buffer.find(separator)) < 0:
+            if self._eof:
+                raise asyncio.IncompleteReadError(bytes(self._buffer), None)
+            await self._fill()
+        return await self.read(position + len(separator))
+
+    async def readexactly(self, n: int) -> bytes:
+        while len(self._buffer) < n:
+            if self._eof:
+                raise asyncio.IncompleteReadError(bytes(self._buffer), n)
+            await self._fill()
+        return await self.read(n)
+
+
+class FrameSender:
+    """Writes the frames of all requests on one multiplexed connection
+
+    While a file region goes out with sendfile the transport must not be
+    written to, frames of other requests are held back until it is done.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._lock = asyncio.Lock()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._backlog = []
+
+    def send(self, request_id: int, kind: int, payload: bytes = b""):
+        header = FRAME_HEADER.pack(request_id, kind, len(payload))
+        if self._idle.is_set():
+            self.writer.writelines((header, payload))
+        else:
+            self._backlog += (header, bytes(payload))
+
+    async def drain(self):
+        await self._idle.wait()
+        await self.writer.drain()
+
+    async def sendfile(self, request_id: int, file, offset: int, count: int):
+        loop = asyncio.get_running_loop()
+        while count > 0:
+            size = min(count, SENDFILE_SIZE)
+            async with self._lock:
+                await self.writer.drain()
+                self.writer.write(FRAME_HEADER.pack(request_id, DATA, size))
+                self._idle.clear()
+                try:
+                    sent = await loop.sendfile(self.writer.transport, file, offset, size)
+                finally:
+                    backlog, self._backlog = self._backlog, []
+                    self.writer.writelines(backlog)
+                    self._idle.set()
+            if sent < size:
+                # The frame promised more bytes than the file has left
+                self.writer.close()
+                raise ConnectionResetError(f"{file.name} was truncated while being sent")
+            offset += size
+            count -= size
+            await self.writer.drain()
+
+
+class FrameWriter:
+    """Response stream of one multiplexed request"""
+
+    def __init__(self, sender: FrameSender, request_id: int):
+        self._sender = sender
+        self._request_id = request_id
+        self._closed = False
+        self.sent = 0
+
+    def write(self, data: bytes):
+        self.sent += len(data)
+        data = memoryview(data)
+        for i in range(0, len(data), FRAME_SIZE):
+            self._sender.send(self._request_id, DATA, data[i:i + FRAME_SIZE])
+
+    def write_eof(self):
+        self._sender.send(self._request_id, EOF)
+
+    async def drain(self):
+        await self._sender.drain()
+
+    async def sendfile(self, file, offset: int, count: int):
+        self.sent += count
+        await self._sender.sendfile(self._request_id, file, offset, count)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._sender.send(self._request_id, CLOSE)
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return self._sender.writer.get_extra_info(name, default)
+
+
+async def write_file(writer, file, offset: int = 0, count: int | None = None):
+    """Send a region of an open file, the kernel copies it with sendfile"""
+    if count is None:
+        count = os.fstat(file.fileno()).st_size - offset
+    if count <= 0:
+        return
+    if isinstance(writer, FrameWriter):
+        await writer.sendfile(file, offset, count)
+    else:
+        await writer.drain()
+        await asyncio.get_running_loop().sendfile(writer.transport, file, offset, count)
+
+
+async def write_region(writer, path: str, offset: int, count: int, throttle=None):
+    """Send a byte span of a plain document or a chunk, at most at the rate of ``throttle``"""
+    if store.is_compressed(path):
+        # Chunks never change, their path is enough to cache them by
+        data = CACHE.get(path, "chunk")
+        if data is None:
+            data = await asyncio.to_thread(store.load_chunk, path)
+            CACHE.put(path, "chunk", data)
+        if throttle is not None:
+            await throttle.consume(count)
+        writer.write(data[offset:offset + count])
+        await writer.drain()
+        return
+    with await asyncio.to_thread(open, path, 'rb') as file:
+        if throttle is None:
+            await write_file(writer, file, offset, count)
+            return
+        for start in range(offset, offset + count, SENDFILE_SIZE):
+            size = min(SENDFILE_SIZE, offset + count - start)
+            await throttle.consume(size)
+            await write_file(writer, file, start, size)
+
+
+async def cached_document(filename: str) -> bytes | None:
+    """Contents of a document from the cache, read into it if they fit"""
+    version = await asyncio.to_thread(store.version, filename)
+    data = CACHE.get(filename, version)
+    if data is None and CACHE.fits(await asyncio.to_thread(store.size, filename)):
+        data = await asyncio.to_thread(store.read_all, filename)
+        CACHE.put(filename, version, data)
+    return data
+
+
+async def line_offsets(filename: str):
+    """Line offsets of a document from the cache, read into it if missing"""
+    path = await offsets_path(filename)
+    stat = await asyncio.to_thread(os.stat, path)
+    version = f"offsets {stat.st_size}:{stat.st_mtime_ns}"
+    line_starts = CACHE.get(filename, version)
+    if line_starts is None:
+        line_starts = await asyncio.to_thread(offsets.load, path)
+        CACHE.put(filename, version, line_starts)
+    return line_starts
+
+
+async def write_document(writer, filename: str, offset: int = 0, count: int | None = None, throttle=None):
+    """Send a byte span of a stored document, from the cache if it is hot, else chunk by chunk if it is chunked"""
+    if throttle is None and (data := await cached_document(filename)) is not None:
+        writer.write(memoryview(data)[offset:None if count is None else offset + count])
+        await writer.drain()
+        return
+    for path, region_offset, region_count in await asyncio.to_thread(store.regions, filename, offset, count):
+        await write_region(writer, path, region_offset, region_count, throttle)
+
+
+async def run_cpu(func, *args):
+    """Run CPU-heavy work in the process pool so the event loop keeps serving"""
+    return await asyncio.get_running_loop().run_in_executor(POOL, func, *args)
+
+
+async def offsets_path(filename: str) -> str:
+    index_path = store.sidecar(filename, "offsets")
+    if not os.path.exists(index_path):
+        await run_cpu(search.index_offsets, filename)
+    return index_path
+
+
+async def folded_path(filename: str) -> str:
+    shadow_path = store.sidecar(filename, "folded")
+    if not os.path.exists(store.sidecar(filename, "folded_offsets")):
+        await run_cpu(search.index_folded, filename)
+    return shadow_path
+
+
+async def index_document(filename: str, renames: list[tuple[str, str]]):
+    """Publish a new version of a document together with its indexes
+
+    The last rename moves the document's plain file or manifest in place. The
+    sidecars are built from that temporary file and published in the same
+    batch right before it, so searches never combine the new version with the
+    old indexes; store.drop_stale_sidecars repairs a batch cut short.
+    """
+    try:
+        sidecars, has_trigrams = await run_cpu(search.index_file, filename, TRIGRAM_MAX_SIZE, renames[-1][0])
+    except BaseException:
+        await asyncio.to_thread(store.discard, renames)
+        raise
+    if not has_trigrams:
+        # The old trigram index must not outlive the old version
+        await asyncio.to_thread(store.drop_sidecars, filename, "trigrams")
+        info(f"{filename} is too large for a trigram index")
+    await publish(sidecars + renames)
+    CACHE.discard(filename)
+
+
+async def apply_tree_change(tree: merkle.MerkleTree, filename: str):
+    if await asyncio.to_thread(store.exists, filename):
+        tree.set(filename, await run_cpu(store.checksum, filename))
+    else:
+        tree.discard(filename)
+
+
+async def update_tree(filename: str):
+    """Reflect a stored or deleted document in the Merkle tree"""
+    if TREE is not None:
+        await apply_tree_change(TREE, filename)
+    elif TREE_CHANGES is not None:
+        TREE_CHANGES.add(filename)
+
+
+async def merkle_tree() -> merkle.MerkleTree:
+    global TREE, TREE_CHANGES
+    async with TREE_LOCK:
+        if TREE is None:
+            TREE_CHANGES = set()
+            tree = merkle.MerkleTree(await run_cpu(store.checksums))
+            while TREE_CHANGES:
+                await apply_tree_change(tree, TREE_CHANGES.pop())
+            TREE, TREE_CHANGES = tree, None
+            info(f"Merkle tree of {sum(map(len, tree.buckets))} documents loaded")
+    return TREE
+
+
+def pin(digests):
+    digests = list(digests)
+    PINNED.update(digests)
+    if KEEP is not None:
+        KEEP.update(digests)
+
+
+def unpin(digests):
+    for digest in digests:
+        PINNED[digest] -= 1
+        if PINNED[digest] <= 0:
+            del PINNED[digest]
+
+
+def schedule_gc():
+    global gc_handle
+    if gc_handle is None:
+        gc_handle = asyncio.get_running_loop().call_later(
+            GC_DELAY, lambda: asyncio.create_task(collect_garbage())
+        )
+
+
+async def collect_garbage():
+    """Remove chunks no manifest refers to"""
+    global KEEP, gc_handle
+    gc_handle = None
+    KEEP = set(PINNED)
+    try:
+        referenced = await run_cpu(store.referenced_chunks)
+        stored = await asyncio.to_thread(lambda: list(store.stored_chunks()))
+        garbage = [path for digest, path in stored if digest not in referenced and digest not in KEEP]
+        for path in garbage:
+            os.remove(path)
+        info(f"Removed {len(garbage)} unused chunks")
+    finally:
+        KEEP = None
+
 
 async def read(reader, sep: str = "#"):
+    if isinstance(reader, FrameReader):
+        return reader.args.popleft()
     data = await reader.readuntil(sep.encode())
     return data.decode()[:-1]
 
 
+async def read_json(reader):
+    size, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    return json.loads(await reader.readexactly(size))
+
+
+def json_message(value) -> bytes:
+    data = json.dumps(value).encode()
+    return LENGTH.pack(len(data)) + data
+
+
+def has_args(reader) -> bool:
+    """Whether optional arguments follow, only multiplexed requests carry them"""
+    return isinstance(reader, FrameReader) and bool(reader.args)
+
+
+async def read_body(reader):
+    while file_data := await reader.read(BATCH_SIZE):
+        yield file_data
+
+
+async def publish(renames: list[tuple[str, str]]):
+    """Move files written to temporary paths in place once they are on disk"""
+    try:
+        await SYNC.sync(temporary for temporary, _ in renames)
+        directories = await asyncio.to_thread(store.publish, renames)
+    except BaseException:
+        await asyncio.to_thread(store.discard, renames)
+        raise
+    await SYNC.sync(directories)
+
+
+async def publish_manifest(filename: str, manifest: list[tuple[str, int]], renames: list[tuple[str, str]]):
+    """Publish new chunks, then the manifest that refers to them with the indexes"""
+    await publish(renames)
+    await index_document(filename, [await asyncio.to_thread(store.write_manifest, filename, manifest)])
+    await asyncio.to_thread(store.drop_layout, filename, False)
+
+
+async def store_document(filename: str, pieces):
+    """Store a document from an async iterable of its bytes, replacing the old version
+
+    Nothing of the new version is visible until it is completely on disk.
+    """
+    replaced = await asyncio.to_thread(store.is_chunked, filename)
+    renames = []
+
+    try:
+        if STORAGE_FORMAT == "chunked":
+            chunker, manifest = chunks.Chunker(), []
+
+            async def keep(piece):
+                digest = chunks.digest(piece)
+                pin([digest])
+                manifest.append((digest, len(piece)))
+                written = await asyncio.to_thread(store.write_chunk, digest, piece)
+                if written is not None:
+                    renames.append(written)
+
+            try:
+                async for file_data in pieces:
+                    for piece in chunker.feed(file_data):
+                        await keep(piece)
+                for piece in chunker.finish():
+                    await keep(piece)
+                await publish_manifest(filename, manifest, renames)
+            finally:
+                unpin(digest for digest, _ in manifest)
+        else:
+            path = store.plain_path(filename)
+            renames.append((store.temporary_path(path), path))
+            buffer = bytearray()
+            with await asyncio.to_thread(open, renames[0][0], "wb") as file:
+                async for file_data in pieces:
+                    buffer += file_data
+                    if len(buffer) >= WRITE_SIZE:
+                        await asyncio.to_thread(file.write, buffer)
+                        buffer.clear()
+                await asyncio.to_thread(file.write, buffer)
+            await index_document(filename, renames)
+            await asyncio.to_thread(store.drop_layout, filename, True)
+    except BaseException:
+        await asyncio.to_thread(store.discard, renames)
+        raise
+
+    if replaced:
+        schedule_gc()
+    await update_tree(filename)
+
+
 async def add_file(reader, writer):
     filename = await read(reader)
     info(f"Received {filename}")
-
-    with open(os.path.join("root", filename), 'wb') as file:
-        file_data = await reader.read(BATCH_SIZE)
-        while file_data:
-            file.write(file_data)
-            file_data = await reader.read(BATCH_SIZE)
+    await store_document(filename, read_body(reader))
     writer.write("OK#".encode())
     info(f"{filename} received successfully")
 
 
+async def add_many(reader, writer):
+    """Add several files with one request
+
+    Every file is a JSON header {"name": ..., "size": ...}, a newline and
+    ``size`` bytes. The reply is the JSON list of statuses, "OK" or "Fail".
+    """
+    statuses = []
+    while True:
+        try:
+            header = json.loads(await reader.readuntil(b"\n"))
+        except asyncio.IncompleteReadError as er:
+            if er.partial:
+                raise
+            break
+        filename, left = header["name"], header["size"]
+
+        async def body():
+            nonlocal left
+            while left > 0:
+                file_data = await reader.readexactly(min(left, FRAME_SIZE))
+                left -= len(file_data)
+                yield file_data
+
+        try:
+            await store_document(filename, body())
+            statuses.append("OK")
+        except (OSError, ValueError) as er:
+            warning(f"Adding {filename} failed: {er!r}")
+            statuses.append("Fail")
+            # Skip the rest of the file to reach the next header
+            while left > 0:
+                left -= len(await reader.readexactly(min(left, FRAME_SIZE)))
+
+    writer.write(json.dumps(statuses).encode())
+    info(f"Received {statuses.count('OK')} of {len(statuses)} files")
+
+
+async def add_chunks(reader, writer):
+    """Add a file, receiving only the chunks this node does not hold yet
+
+    The body starts with the JSON manifest [[sha256, size], ...], the reply lists
+    indices of the chunks to send, which follow in that order. Both are preceded
+    by their length as a 4-byte big-endian integer.
+    """
+    filename = await read(reader)
+    manifest = [(digest, size) for digest, size in await read_json(reader)]
+    info(f"Received manifest of {filename} with {len(manifest)} chunks")
+    replaced = await asyncio.to_thread(store.is_chunked, filename)
+
+    async def received():
+        for i in missing:
+            digest, size = manifest[i]
+            data = await reader.readexactly(size)
+            if chunks.digest(data) != digest:
+                raise ValueError(f"Chunk {i} of {filename} does not match its digest")
+            yield digest, data
+
+    if STORAGE_FORMAT != "chunked":
+        missing = list(range(len(manifest)))
+        writer.write(json_message(missing))
+        await writer.drain()
+        await store_document(filename, (data async for _, data in received()))
+        writer.write("OK#".encode())
+        info(f"{filename} received successfully")
+        return
+
+    def find_missing():
+        wanted, result = set(), []
+        for i, (digest, _) in enumerate(manifest):
+            if digest not in wanted and not store.has_chunk(digest):
+                wanted.add(digest)
+                result.append(i)
+        return result
+
+    pin(digest for digest, _ in manifest)
+    renames = []
+    try:
+        missing = await asyncio.to_thread(find_missing)
+        writer.write(json_message(missing))
+        await writer.drain()
+        async for digest, data in received():
+            written = await asyncio.to_thread(store.write_chunk, digest, data)
+            if written is not None:
+                renames.append(written)
+        await publish_manifest(filename, manifest, renames)
+    except BaseException:
+        await asyncio.to_thread(store.discard, renames)
+        raise
+    finally:
+        unpin(digest for digest, _ in manifest)
+
+    if replaced:
+        schedule_gc()
+    await update_tree(filename)
+    writer.write("OK#".encode())
+    info(f"{filename} received successfully, {len(missing)} of {len(manifest)} chunks transferred")
+
+
+async def patch_file(reader, writer):
+    """Rebuild a file from a delta against the stored version
+
+    The reply starts with the block signatures of the stored version,
+    {"size": n, "block_size": n, "blocks": [[weak, strong], ...]} and a newline,
+    then the delta described in delta.py is read.
+    """
+    filename = await read(reader)
+    signature = await run_cpu(delta.signatures, filename)
+    size, blocks = signature["block_size"], signature["blocks"]
+    writer.write(json.dumps(signature).encode() + b"\n")
+    await writer.drain()
+    info(f"Sent {len(blocks)} block signatures of {filename}")
+
+    old_chunks = await asyncio.to_thread(
+        lambda: store.read_manifest(filename) if blocks and store.is_chunked(filename) else []
+    )
+    pin(digest for digest, _ in old_chunks)
+    copied = received = 0
+
+    async def rebuild(view):
+        nonlocal copied, received
+        hasher = hashlib.sha256()
+        while (op := await reader.readexactly(1)) != delta.END:
+            value, = delta.U32.unpack(await reader.readexactly(delta.U32.size))
+            if op == delta.COPY:
+                if value >= len(blocks):
+                    raise ValueError(f"Delta of {filename} refers to missing block {value}")
+                file_data = await asyncio.to_thread(view.__getitem__, slice(value * size, (value + 1) * size))
+                copied += len(file_data)
+                hasher.update(file_data)
+                yield file_data
+            elif op == delta.LITERAL:
+                while value > 0:
+                    file_data = await reader.readexactly(min(value, BATCH_SIZE))
+                    value -= len(file_data)
+                    received += len(file_data)
+                    hasher.update(file_data)
+                    yield file_data
+            else:
+                raise ValueError(f"Unknown delta instruction {op!r} for {filename}")
+        if await reader.readexactly(hasher.digest_size) != hasher.digest():
+            raise ValueError(f"Patched {filename} does not match its digest")
+
+    try:
+        with ExitStack() as stack:
+            view = await asyncio.to_thread(store.open_view, stack, filename) if blocks else b""
+            await store_document(filename, rebuild(view))
+    finally:
+        unpin(digest for digest, _ in old_chunks)
+
+    writer.write("OK#".encode())
+    info(f"{filename} patched successfully, {copied} bytes copied, {received} bytes received")
+
+
 async def delete_file(reader):
     filename = await read(reader)
-    os.remove(os.path.join("root", filename))
+    chunked = await asyncio.to_thread(store.is_chunked, filename)
+    await asyncio.to_thread(store.remove, filename)
+    if chunked:
+        schedule_gc()
+    CACHE.discard(filename)
+    await update_tree(filename)
     info(f"{filename} deleted successfully")
 
 
+async def delete_many(reader, writer):
+    """Delete several files, the body is the JSON list of their names
+
+    The reply is the JSON list of statuses: "OK", "Missing" or "Fail".
+    """
+    filenames = json.loads(await reader.read())
+
+    def remove_all():
+        statuses, chunked = [], False
+        for filename in filenames:
+            try:
+                chunked |= store.is_chunked(filename)
+                store.remove(filename)
+                statuses.append("OK")
+            except FileNotFoundError:
+                statuses.append("Missing")
+            except OSError as er:
+                warning(f"Deleting {filename} failed: {er!r}")
+                statuses.append("Fail")
+        return statuses, chunked
+
+    statuses, chunked = await asyncio.to_thread(remove_all)
+    if chunked:
+        schedule_gc()
+    for filename in filenames:
+        CACHE.discard(filename)
+        await update_tree(filename)
+    writer.write(json.dumps(statuses).encode())
+    info(f"Deleted {statuses.count('OK')} of {len(filenames)} files")
+
+
 async def get_file(reader, writer):
     filename = await read(reader)
-    with open(os.path.join("root", filename), 'rb') as file:
-        file_data = file.read(BATCH_SIZE)
-        while file_data:
-            writer.write(file_data)
-            file_data = file.read(BATCH_SIZE)
+    offset, count = 0, None
+    if has_args(reader):
+        # "lines", first, last (1-based, inclusive) or "bytes", offset, count
+        unit = await read(reader)
+        first = int(await read(reader))
+        last = int(await read(reader))
+        if unit == "lines":
+            begin, end = offsets.span(await line_offsets(filename), first, last)
+            offset = await asyncio.to_thread(store.size, filename) if begin is None else begin
+            count = None if end is None else end - offset
+        else:
+            offset, count = first, last
+        info(f"Sending {unit} {first}:{last} of {filename}")
+
+    await write_document(writer, filename, offset, count)
     writer.write_eof()
     await writer.drain()
     info(f"{filename} sent successfully")
 
 
 async def find_substring(reader, writer):
+    """Lines in a range containing the substring sent as the body
+
+    A multiplexed request may add a JSON object of options:
+    {"regex": true} searches for a regular expression, {"ignore_case": true}
+    ignores case and {"whole_word": true} only matches whole words. The reply
+    is "Y#" and the line numbers separated by ";", "N#" if none match, or "E#"
+    and the reason the search failed. With {"snippet": width} the line numbers
+    are followed by the text of the lines, cut to ``width`` characters around
+    the match: "Y#" is followed by one JSON array [number, text] per line,
+    sent in batches while they are read.
+
+    {"limit": n} stops the search after the first n lines of the range and
+    {"exists": true} after the first one. {"count_only": true} replies "C#"
+    and the number of lines instead of the lines.
+    """
     filename = await read(reader)
     start = await read(reader)
     start = int(start)
     stop = await read(reader)
     stop = int(stop)
+    options = json.loads(await read(reader)) if has_args(reader) else {}
 
     substring = ""
     file_data = await reader.read(BATCH_SIZE)
@@ -58,21 +737,42 @@ async def find_substring(reader, writer):
         substring += file_data.decode()
         file_data = await reader.read(BATCH_SIZE)
 
-    info(f"Searching for {substring.__repr__()} in {filename} from {start} to {stop}")
+    info(f"Searching for {substring.__repr__()} in {filename} from {start} to {stop} {options}")
 
-    line_number = start
-    found_lines = []
-    with open(os.path.join('root', filename), 'r', encoding='utf-8') as file:
-        lines = itertools.islice(file, start - 1, stop)
-        for line in lines:
-            if substring in line:
-                found_lines.append(str(line_number))
-            line_number += 1
+    ignore_case, whole_word = bool(options.get("ignore_case")), bool(options.get("whole_word"))
+    limit = 1 if options.get("exists") else options.get("limit")
+    await offsets_path(filename)
+    try:
+        if options.get("regex"):
+            found_lines = await run_cpu(search.find_regex, filename, substring, start, stop, REGEX_BUDGET,
+                                        ignore_case, whole_word, limit)
+        else:
+            if ignore_case:
+                await folded_path(filename)
+            found_lines = await run_cpu(search.find_lines, filename, substring.encode(), start, stop,
+                                        ignore_case, whole_word, limit)
+    except (re.error, TimeoutError) as er:
+        writer.write(f"E#{er}".encode())
+        info(f"Search failed: {er}")
+        return
+    width = options.get("snippet")
 
-    if found_lines:
+    if options.get("count_only"):
+        writer.write(f"C#{len(found_lines)}".encode())
+        info(f"Found {len(found_lines)} lines")
+    elif found_lines and width:
+        writer.write("Y#".encode())
+        for first in range(0, len(found_lines), SNIPPET_BATCH):
+            records = await run_cpu(search.snippets, filename, found_lines[first:first + SNIPPET_BATCH],
+                                    substring, width, REGEX_BUDGET, bool(options.get("regex")),
+                                    ignore_case, whole_word)
+            writer.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode())
+            await writer.drain()
+        info(f"Found {len(found_lines)} lines")
+    elif found_lines:
         writer.write("Y#".encode())
         await writer.drain()
-        writer.write(';'.join(found_lines).encode())
+        writer.write(';'.join(map(str, found_lines)).encode())
         info(f"Found {len(found_lines)} lines")
     else:
         writer.write("N#".encode())
@@ -81,83 +781,366 @@ async def find_substring(reader, writer):
     info(f"{filename} sent successfully")
 
 
+async def find_many(reader, writer):
+    filename = await read(reader)
+    start = int(await read(reader))
+    stop = int(await read(reader))
+    patterns = json.loads(await reader.read())
+
+    info(f"Searching for {len(patterns)} patterns in {filename} from {start} to {stop}")
+    await offsets_path(filename)
+    hits = await run_cpu(search.find_many, filename, [pattern.encode() for pattern in patterns], start, stop)
+    writer.write(json.dumps(hits).encode())
+    await writer.drain()
+    info(f"Found {sum(map(len, hits))} lines")
+
+
 def end():
     info("Removing root dir...")
     rmtree("root")
     info("root dir was successfully removed")
+    POOL.shutdown(wait=False, cancel_futures=True)
     loop = asyncio.get_running_loop()
     loop.stop()
     info("Session is ended")
 
 
-async def send_file(host, port, filename):
+async def send_file(host, port, filename, throttle):
+    """Copy a document to another node, only the chunks it lacks if the document is chunked"""
     reader, writer = await asyncio.open_connection(host, port)
-    writer.write("Add#".encode())
-    writer.write((filename + "#").encode())
-    await writer.drain()
+    try:
+        if await asyncio.to_thread(store.is_chunked, filename):
+            manifest = await asyncio.to_thread(store.read_manifest, filename)
+            writer.write(f"AddChunks#{filename}#".encode())
+            writer.write(json_message(manifest))
+            await writer.drain()
+            for i in await read_json(reader):
+                digest, size = manifest[i]
+                await write_region(writer, await asyncio.to_thread(store.find_chunk, digest), 0, size, throttle)
+        else:
+            writer.write(f"Add#{filename}#".encode())
+            await writer.drain()
+            await write_document(writer, filename, throttle=throttle)
 
-    with open(os.path.join("root", filename), 'rb') as file:
-        file_data = file.read(BATCH_SIZE)
-        while file_data:
-            writer.write(file_data)
-            file_data = file.read(BATCH_SIZE)
+        writer.write_eof()
+        await writer.drain()
+        await reader.readuntil("#".encode())
+    finally:
+        writer.close()
+        await writer.wait_closed()
 
-    await writer.drain()
-    writer.close()
-    await writer.wait_closed()
+
+async def copy_documents(host: str, port: int, names: list[str], throttle, copied=None) -> list[str]:
+    """Send documents to another node, returns the ones that could not be sent
+
+    At most ``REPLICATION_WINDOW`` documents are sent at once, failed ones are
+    retried with a growing delay. ``copied(name, version)`` is awaited after
+    each document the node confirmed.
+    """
+    queue = iter(names)
+    done, failed = 0, []
+
+    async def copy_next():
+        nonlocal done
+        for name in queue:
+            version = await asyncio.to_thread(lambda: store.version(name) if store.exists(name) else None)
+            if version is None:
+                continue
+            for attempt in range(REPLICATION_RETRIES):
+                try:
+                    await send_file(host, port, name, throttle)
+                    break
+                except (OSError, asyncio.IncompleteReadError) as er:
+                    warning(f"Copying {name} to {host}:{port} failed: {er!r}")
+                    if attempt + 1 < REPLICATION_RETRIES:
+                        await asyncio.sleep(2 ** attempt)
+            else:
+                failed.append(name)
+                continue
+            if copied is not None:
+                await copied(name, version)
+            done += 1
+
+    async def report():
+        start = asyncio.get_running_loop().time()
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            rate = throttle.sent / (asyncio.get_running_loop().time() - start)
+            info(f"Copying to {host}:{port}: {done}/{len(names)} documents, {throttle.sent} bytes, {rate:.0f} B/s")
+
+    reporter = asyncio.create_task(report())
+    try:
+        await asyncio.gather(*(copy_next() for _ in range(REPLICATION_WINDOW)))
+    finally:
+        reporter.cancel()
+    return failed
+
+
+async def replicate(host: str, port: int):
+    """Copy all documents to another node
+
+    Sends are no faster than ``REPLICATION_BANDWIDTH`` bytes per second in
+    total. A copy that was interrupted resumes from its checkpoint.
+    """
+    checkpoint = replication.Checkpoint(host, port)
+    copied = await asyncio.to_thread(checkpoint.load)
+    names = await asyncio.to_thread(
+        lambda: [name for name in store.documents() if copied.get(name) != store.version(name)]
+    )
+    info(f"Copying {len(names)} documents to {host}:{port}, {len(copied)} copied before")
+
+    throttle = replication.Throttle(REPLICATION_BANDWIDTH)
+    failed = await copy_documents(
+        host, port, names, throttle,
+        lambda name, version: asyncio.to_thread(checkpoint.record, name, version)
+    )
+
+    if failed:
+        warning(f"Copy to {host}:{port} left {len(failed)} documents behind, the next copy resumes")
+    else:
+        await asyncio.to_thread(checkpoint.remove)
+        info(f"Copied {len(names)} documents, {throttle.sent} bytes to {host}:{port}")
 
 
-async def add_server(reader):
-    async def create_task(args):
-        func, *args = args
-        await func(*args)
+def start_replication(host: str, port: int) -> asyncio.Task:
+    """Start a copy, or join the one already running to the same node"""
+    target = (host, port)
+    if target not in REPLICATIONS:
+        task = REPLICATIONS[target] = asyncio.create_task(replicate(host, port))
+        task.add_done_callback(lambda _: REPLICATIONS.pop(target, None))
+    return REPLICATIONS[target]
 
+
+async def add_server(reader, writer):
     host = await read(reader)
     port = await read(reader)
     port = int(port)
 
-    tasks = [asyncio.create_task(send_file(host, port, f))
-             for f in os.listdir('root') if os.path.isfile(os.path.join('root', f))]
+    await asyncio.shield(start_replication(host, port))
+    writer.write("OK#".encode())
+
+
+async def call_node(host: str, port: int, command: str, body: bytes = b"") -> bytes:
+    """Run a command on another node, returns its whole reply"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"{command}#".encode() + body)
+        writer.write_eof()
+        await writer.drain()
+        return await reader.read()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def get_tree(writer):
+    """Root and bucket hashes of the Merkle tree as JSON"""
+    tree = await merkle_tree()
+    writer.write(json.dumps({"root": tree.root(), "buckets": tree.bucket_hashes()}).encode())
+
+
+async def get_tree_leaves(reader, writer):
+    """Leaves of the buckets listed in the JSON body, as a list of {name: checksum}"""
+    buckets = json.loads(await reader.read())
+    tree = await merkle_tree()
+    writer.write(json.dumps([tree.buckets[bucket] for bucket in buckets]).encode())
+
+
+async def sync_server(reader, writer):
+    """Make another node hold the same version of every document of this node
+
+    Only the leaves of buckets whose hashes differ are fetched and only the
+    documents the other node lacks or holds with a different checksum are
+    sent. The reply reports them and the documents only the other node has.
+    """
+    host = await read(reader)
+    port = int(await read(reader))
+    tree = await merkle_tree()
+
+    remote = json.loads(await call_node(host, port, "Tree"))
+    buckets = tree.differing(remote["buckets"]) if remote["root"] != tree.root() else []
+    leaves = json.loads(await call_node(host, port, "TreeLeaves", json.dumps(buckets).encode())) if buckets else []
+
+    names, extra = [], []
+    for bucket, theirs in zip(buckets, leaves):
+        ours = tree.buckets[bucket]
+        names += [name for name, checksum in ours.items() if theirs.get(name) != checksum]
+        extra += [name for name in theirs if name not in ours]
+    info(f"{len(buckets)} buckets differ from {host}:{port}, sending {len(names)} documents")
+
+    failed = await copy_documents(host, port, names, replication.Throttle(REPLICATION_BANDWIDTH))
+    writer.write(json.dumps({
+        "buckets": len(buckets),
+        "sent": [name for name in names if name not in failed],
+        "failed": failed,
+        "extra": extra,
+    }).encode())
 
-    await asyncio.wait(tasks)
+
+async def copy_many(reader, writer):
+    """Send the documents listed in the JSON body to another node
+
+    The reply reports the documents "sent" and the ones that "failed",
+    including those this node does not hold.
+    """
+    host = await read(reader)
+    port = int(await read(reader))
+    names = json.loads(await reader.read())
+    held = await asyncio.to_thread(lambda: [name for name in names if store.exists(name)])
+    info(f"Sending {len(held)} of {len(names)} requested documents to {host}:{port}")
+
+    failed = await copy_documents(host, port, held, replication.Throttle(REPLICATION_BANDWIDTH))
+    writer.write(json.dumps({
+        "sent": [name for name in held if name not in failed],
+        "failed": failed + [name for name in names if name not in held],
+    }).encode())
 
 
 async def get_info(writer):
+    """Free and total disk space, then the size of stored documents and the space they take with their indexes"""
     total, _, free = shutil.disk_usage("/")
-    writer.write(f"{free}/{total}#".encode())
+    logical, stored = await asyncio.to_thread(store.usage)
+    writer.write(f"{free}/{total}/{logical}/{stored}#".encode())
+
+
+async def get_stats(writer):
+    """Load counters of the node as JSON, see stats.py"""
+    summary = STATS.summary()
+    summary["storage"] = await asyncio.to_thread(store.index_usage)
+    summary["pinned_chunks"] = len(PINNED)
+    summary["fsync"] = {"groups": SYNC.groups, "paths": SYNC.paths}
+    summary["replications"] = len(REPLICATIONS)
+    summary["cache"] = CACHE.summary()
+    writer.write(json.dumps(summary).encode())
 
 
 async def ping(writer):
     writer.write("OK#".encode())
 
 
-async def handle_client(reader, writer):
+async def dispatch(command, reader, writer):
     addr = writer.get_extra_info('peername')
-    info(f"Connection from {addr}")
-
-    command = await read(reader)
     info(f"Received {command} from {addr}")
 
     match command:
         case "Add":
             await add_file(reader, writer)
+        case "AddMany":
+            await add_many(reader, writer)
+        case "AddChunks":
+            await add_chunks(reader, writer)
+        case "Patch":
+            await patch_file(reader, writer)
         case "Delete":
             await delete_file(reader)
+        case "DeleteMany":
+            await delete_many(reader, writer)
         case "Get":
             await get_file(reader, writer)
         case "Find":
             await find_substring(reader, writer)
+        case "FindMany":
+            await find_many(reader, writer)
         case "AddServer":
-            await add_server(reader)
+            await add_server(reader, writer)
+        case "Sync":
+            await sync_server(reader, writer)
+        case "CopyMany":
+            await copy_many(reader, writer)
+        case "Tree":
+            await get_tree(writer)
+        case "TreeLeaves":
+            await get_tree_leaves(reader, writer)
         case "End":
             end()
         case "Info":
             await get_info(writer)
+        case "Stats":
+            await get_stats(writer)
         case "Ping":
             await ping(writer)
         case _:
             warning(f"Unknown command {command} from {addr}")
 
+
+async def run_request(command, request_id, body, sender, requests):
+    response = FrameWriter(sender, request_id)
+    counters = STATS.begin(command)
+    started = asyncio.get_running_loop().time()
+    failed = True
+    try:
+        await dispatch(command, body, response)
+        failed = False
+    except asyncio.CancelledError:
+        # The client closed the request, it needs no more of the response
+        failed = False
+        info(f"{command} cancelled by the client")
+        raise
+    except Exception as er:
+        warning(f"{command} failed: {er!r}")
+    finally:
+        STATS.end(counters, asyncio.get_running_loop().time() - started, failed, body.received, response.sent)
+        requests.pop(request_id, None)
+        body.discard()
+        response.close()
+
+
+async def serve_multiplexed(reader, writer):
+    requests: dict[int, FrameReader] = {}
+    sender = FrameSender(writer)
+    tasks = set()
+    searches: dict[int, asyncio.Task] = {}
+    while True:
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+            request_id, kind, length = FRAME_HEADER.unpack(header)
+            payload = await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            break
+
+        if kind == CALL:
+            command, *args = json.loads(payload)
+            body = requests[request_id] = FrameReader(args)
+            task = asyncio.create_task(run_request(command, request_id, body, sender, requests))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if command in CANCELLABLE:
+                searches[request_id] = task
+                task.add_done_callback(lambda _, request_id=request_id: searches.pop(request_id, None))
+        elif kind in (DATA, EOF) and request_id in requests:
+            await requests[request_id].feed(payload if kind == DATA else b"")
+        elif kind == CLOSE and request_id in searches:
+            searches[request_id].cancel()
+        elif kind == CLOSE and request_id in requests:
+            # The client gave up on the request: a handler still reading its
+            # body, e.g. of an unfinished upload, fails and discards it
+            requests[request_id].abort()
+
+    for body in requests.values():
+        body.abort()
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info('peername')
+    info(f"Connection from {addr}")
+
+    command = await read(reader)
+    if command == "Mux":
+        info(f"Multiplexing requests from {addr}")
+        await serve_multiplexed(reader, writer)
+    else:
+        # Only requests and latency are counted on plain connections, not bytes
+        counters = STATS.begin(command)
+        started = asyncio.get_running_loop().time()
+        failed = True
+        try:
+            await dispatch(command, reader, writer)
+            failed = False
+        finally:
+            STATS.end(counters, asyncio.get_running_loop().time() - started, failed)
+
     writer.close()
     await writer.wait_closed()
     info(f"Connection closed from {addr}")
@@ -165,6 +1148,12 @@ async def handle_client(reader, writer):
 
 async def main():
     server = await asyncio.start_server(handle_client, HOST, PORT)
+    # The loop keeps only weak references to tasks
+    lag_watcher = asyncio.create_task(STATS.watch_loop())
+    if stale := await asyncio.to_thread(store.drop_stale_sidecars):
+        warning(f"Dropped indexes of {len(stale)} documents left from interrupted writes")
+    for host, port in replication.pending():
+        start_replication(host, port)
 
     addr = server.sockets[0].getsockname()
     info(f'Serving on {addr}...')
@@ -190,8 +1179,18 @@ if __name__ == '__main__':
 
     with open("config.yaml", "r", encoding='utf-8') as cfg_file:
         cfg = safe_load(cfg_file)
+    store.setup(cfg['compression'])
 
     BATCH_SIZE = cfg['batch_size']
+    TRIGRAM_MAX_SIZE = cfg['trigram_max_size']
+    REGEX_BUDGET = cfg['regex_budget']
+    STORAGE_FORMAT = cfg['storage_format']
+    # Spawned workers do not inherit the listening socket
+    POOL = ProcessPoolExecutor(cfg['workers'], mp_context=get_context("spawn"))
+    SYNC = durability.SyncGroup(cfg['fsync'])
+    CACHE = cache.ByteCache(cfg['cache_size'])
+    REPLICATION_WINDOW = cfg['replication_window']
+    REPLICATION_BANDWIDTH = cfg['replication_bandwidth']
     HOST, PORT = cfg['host'], cfg['port']
     try:
         asyncio.run(main())
@@ -0,0 +1,327 @@
+"""Layout of documents on a storage node
+
+A document is either a plain file ``root/<name>`` or a manifest
+``root/.manifests/<name>`` listing content-defined chunks kept once in
+``root/.chunks``. Chunks may be compressed one by one, the manifest then serves
+as the block index: reading a byte range decompresses only the chunks covering
+it. A compressed chunk file carries the suffix of its codec, so nodes can change
+compression without rewriting stored chunks. Indexes live in ``root/.index`` and
+always describe the document's bytes, whatever way they are stored.
+"""
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import zlib
+from contextlib import ExitStack
+from itertools import accumulate, count
+
+from chunks import ChunkedView
+
+ROOT = "root"
+INDEX_DIR = os.path.join(ROOT, ".index")
+MANIFEST_DIR = os.path.join(ROOT, ".manifests")
+CHUNK_DIR = os.path.join(ROOT, ".chunks")
+REPLICATION_DIR = os.path.join(ROOT, ".replication")
+SIDECARS = ("version", "offsets", "trigrams", "sha256", "folded", "folded_offsets")
+CODECS = {".z": zlib, ".xz": lzma}
+COMPRESSION = {"none": "", "zlib": ".z", "lzma": ".xz"}
+compression_suffix = ""
+_temporaries = count()
+
+
+def setup(compression: str = "none"):
+    global compression_suffix
+    compression_suffix = COMPRESSION[compression]
+    for directory in (INDEX_DIR, MANIFEST_DIR, CHUNK_DIR, REPLICATION_DIR):
+        os.makedirs(directory, exist_ok=True)
+
+
+def plain_path(name: str) -> str:
+    return os.path.join(ROOT, name)
+
+
+def manifest_path(name: str) -> str:
+    return os.path.join(MANIFEST_DIR, name)
+
+
+def chunk_path(digest: str, suffix: str = "") -> str:
+    return os.path.join(CHUNK_DIR, digest[:2], digest + suffix)
+
+
+def find_chunk(digest: str) -> str | None:
+    for suffix in ("", *CODECS):
+        path = chunk_path(digest, suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_compressed(path: str) -> bool:
+    return os.path.splitext(path)[1] in CODECS
+
+
+def load_chunk(path: str) -> bytes:
+    with open(path, "rb") as file:
+        data = file.read()
+    codec = CODECS.get(os.path.splitext(path)[1])
+    return data if codec is None else codec.decompress(data)
+
+
+def sidecar(name: str, kind: str) -> str:
+    return os.path.join(INDEX_DIR, f"{name}.{kind}")
+
+
+def drop_sidecars(name: str, *kinds: str):
+    for kind in kinds or SIDECARS:
+        try:
+            os.remove(sidecar(name, kind))
+        except FileNotFoundError:
+            pass
+
+
+def is_chunked(name: str) -> bool:
+    return os.path.exists(manifest_path(name))
+
+
+def exists(name: str) -> bool:
+    return os.path.exists(plain_path(name)) or is_chunked(name)
+
+
+def layout_path(name: str) -> str:
+    """The plain file or the manifest of a document"""
+    return manifest_path(name) if is_chunked(name) else plain_path(name)
+
+
+def file_version(path: str) -> str:
+    """Version of the document whose plain file or manifest is ``path``, kept when it is renamed"""
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def version(name: str) -> str:
+    """Changes whenever the document is replaced"""
+    return file_version(layout_path(name))
+
+
+def drop_stale_sidecars() -> list[str]:
+    """Drop indexes that do not describe the stored version of their document
+
+    Only called before any write starts, unfinished sidecars are dropped too.
+    Sidecars are published before the document. The "version" sidecar goes
+    first, so after a crash in between it names a version that is not stored.
+    """
+    stale = []
+    for entry in os.listdir(INDEX_DIR):
+        name, kind = os.path.splitext(entry)
+        if kind == ".tmp":
+            os.remove(os.path.join(INDEX_DIR, entry))
+        if kind != ".version":
+            continue
+        with open(os.path.join(INDEX_DIR, entry), "r", encoding="ascii") as file:
+            stamp = file.read()
+        if not exists(name) or stamp != version(name):
+            drop_sidecars(name)
+            stale.append(name)
+    return stale
+
+
+def documents() -> list[str]:
+    plain = [f for f in os.listdir(ROOT) if os.path.isfile(plain_path(f)) and not f.endswith(".tmp")]
+    return plain + [f for f in os.listdir(MANIFEST_DIR) if not f.endswith(".tmp")]
+
+
+def read_manifest(name: str, path: str | None = None) -> list[tuple[str, int]]:
+    with open(path or manifest_path(name), "r", encoding="utf-8") as file:
+        return [(digest, size) for digest, size in json.load(file)]
+
+
+def temporary_path(path: str) -> str:
+    """Unique path next to ``path`` to write its new version to"""
+    return f"{path}.{os.getpid()}-{next(_temporaries)}.tmp"
+
+
+def write_temporary(path: str, data: bytes) -> tuple[str, str]:
+    """Write data for ``path`` to a temporary file, see ``publish``"""
+    temporary = temporary_path(path)
+    with open(temporary, "wb") as file:
+        file.write(data)
+    return temporary, path
+
+
+def publish(renames: list[tuple[str, str]]) -> set[str]:
+    """Move temporary files in place
+
+    Readers see either the old or the new version of each file, never a part
+    of it. The renames reach the disk once the returned directories are synced.
+    """
+    for temporary, path in renames:
+        os.replace(temporary, path)
+    return {os.path.dirname(path) for _, path in renames}
+
+
+def discard(renames: list[tuple[str, str]]):
+    for temporary, _ in renames:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+
+
+def write_manifest(name: str, manifest: list[tuple[str, int]]) -> tuple[str, str]:
+    return write_temporary(manifest_path(name), json.dumps(manifest).encode())
+
+
+def has_chunk(digest: str) -> bool:
+    return find_chunk(digest) is not None
+
+
+def write_chunk(digest: str, data: bytes) -> tuple[str, str] | None:
+    """Write a chunk to a temporary file, ``None`` if it is stored already"""
+    if has_chunk(digest):
+        return None
+    path = chunk_path(digest, compression_suffix)
+    if compression_suffix:
+        data = CODECS[compression_suffix].compress(data)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return write_temporary(path, data)
+
+
+def drop_layout(name: str, chunked: bool):
+    """Remove the manifest or the plain file left from the previous version"""
+    try:
+        os.remove(manifest_path(name) if chunked else plain_path(name))
+    except FileNotFoundError:
+        pass
+
+
+def remove(name: str):
+    if is_chunked(name):
+        os.remove(manifest_path(name))
+    else:
+        os.remove(plain_path(name))
+    drop_sidecars(name)
+
+
+def size(name: str) -> int:
+    if is_chunked(name):
+        return sum(chunk_size for _, chunk_size in read_manifest(name))
+    return os.path.getsize(plain_path(name))
+
+
+def regions(name: str, offset: int = 0, count: int | None = None,
+            path: str | None = None) -> list[tuple[str, int, int]]:
+    """Files and their byte spans that make up ``count`` bytes of a document from ``offset``
+
+    :param path: plain file or manifest of a version not published yet, see ``layout_path``
+    """
+    path = path or layout_path(name)
+    if os.path.dirname(path) != MANIFEST_DIR:
+        total = os.path.getsize(path)
+        offset = min(offset, total)
+        count = total - offset if count is None else min(count, total - offset)
+        return [(path, offset, count)] if count > 0 else []
+
+    manifest = read_manifest(name, path)
+    end = float("inf") if count is None else offset + count
+    result = []
+    for (digest, chunk_size), start in zip(manifest, accumulate((s for _, s in manifest), initial=0)):
+        begin, stop = max(offset, start), min(end, start + chunk_size)
+        if begin < stop:
+            result.append((find_chunk(digest), begin - start, stop - begin))
+    return result
+
+
+def iter_bytes(name: str, batch_size: int = 1 << 20, path: str | None = None):
+    """Stream the bytes of a document, ``path`` as in ``regions``"""
+    for path, offset, count in regions(name, path=path):
+        if is_compressed(path):
+            yield load_chunk(path)[offset:offset + count]
+            continue
+        with open(path, "rb") as file:
+            file.seek(offset)
+            while count > 0 and (data := file.read(min(batch_size, count))):
+                count -= len(data)
+                yield data
+
+
+def read_all(name: str) -> bytes:
+    return b"".join(iter_bytes(name))
+
+
+def open_view(stack: ExitStack, name: str):
+    """Random access to the bytes of a document: an mmap or a chunked view"""
+    if is_chunked(name):
+        return ChunkedView(read_manifest(name), lambda digest: load_chunk(find_chunk(digest)))
+    file = stack.enter_context(open(plain_path(name), "rb"))
+    if os.fstat(file.fileno()).st_size == 0:
+        return b""
+    return stack.enter_context(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def write_checksum(name: str, checksum: str):
+    os.replace(*write_temporary(sidecar(name, "sha256"), checksum.encode()))
+
+
+def checksum(name: str) -> str:
+    """SHA-256 of the document's bytes, computed and kept as a sidecar if missing"""
+    try:
+        with open(sidecar(name, "sha256"), "r", encoding="ascii") as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+    hasher = hashlib.sha256()
+    for data in iter_bytes(name):
+        hasher.update(data)
+    write_checksum(name, hasher.hexdigest())
+    return hasher.hexdigest()
+
+
+def checksums() -> dict[str, str]:
+    result = {}
+    for name in documents():
+        try:
+            result[name] = checksum(name)
+        except FileNotFoundError:
+            pass  # deleted meanwhile
+    return result
+
+
+def referenced_chunks() -> set[str]:
+    referenced = set()
+    for name in os.listdir(MANIFEST_DIR):
+        if not name.endswith(".tmp"):
+            referenced.update(digest for digest, _ in read_manifest(name))
+    return referenced
+
+
+def stored_chunks():
+    """Digests and paths of all chunk files"""
+    for directory in os.listdir(CHUNK_DIR):
+        for filename in os.listdir(os.path.join(CHUNK_DIR, directory)):
+            if not filename.endswith(".tmp"):
+                yield filename.split(".")[0], os.path.join(CHUNK_DIR, directory, filename)
+
+
+def index_bytes() -> int:
+    with os.scandir(INDEX_DIR) as entries:
+        return sum(entry.stat().st_size for entry in entries)
+
+
+def index_usage() -> dict[str, int]:
+    """Numbers of documents and chunks, size of the indexes"""
+    return {
+        "documents": len(documents()),
+        "chunks": sum(1 for _ in stored_chunks()),
+        "index_bytes": index_bytes(),
+    }
+
+
+def usage() -> tuple[int, int]:
+    """Size of the stored documents and the disk space they take with their indexes"""
+    names = documents()
+    logical = sum(size(name) for name in names)
+    stored = sum(os.path.getsize(plain_path(name)) for name in names if not is_chunked(name))
+    stored += sum(os.path.getsize(path) for _, path in stored_chunks())
+    return logical, stored + index_bytes()
@@ -0,0 +1,122 @@
+"""Trigram inverted index
+
+For every distinct byte trigram of a stored file the index keeps the sorted
+list of line numbers containing it. A substring of three or more bytes can
+only occur on lines that contain all of its trigrams, so a search has to check
+just the intersection of their posting lists.
+
+File layout (little-endian)::
+
+    b"TRI1" | key count (u32) | keys table | postings
+    keys table entry: trigram (u32) | first posting (u64) | posting count (u32)
+    postings: line numbers (u32)
+"""
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+MAGIC = b"TRI1"
+HEADER = struct.Struct("<4sI")
+ENTRY = struct.Struct("<IQI")
+
+
+def _key(trigram: tuple[int, int, int]) -> int:
+    return trigram[0] << 16 | trigram[1] << 8 | trigram[2]
+
+
+class TrigramBuilder:
+    """Indexes a file while it is written chunk by chunk
+
+    Indexing stops once ``limit`` bytes were fed, postings of larger files
+    would not fit in memory; such files are searched by scanning.
+    """
+
+    def __init__(self, limit: int):
+        self.postings: dict[tuple[int, int, int], array] | None = {}
+        self._limit = limit
+        self._size = 0
+        self._line = 1
+        self._tail = b""
+
+    @property
+    def overflowed(self) -> bool:
+        return self.postings is None
+
+    def _add_line(self, line: bytes):
+        postings, number = self.postings, self._line
+        for trigram in set(zip(line, line[1:], line[2:])):
+            lines = postings.get(trigram)
+            if lines is None:
+                lines = postings[trigram] = array("I")
+            lines.append(number)
+        self._line += 1
+
+    def feed(self, data: bytes):
+        if self.overflowed:
+            return
+        self._size += len(data)
+        if self._size > self._limit:
+            self.postings = None
+            return
+        *lines, self._tail = (self._tail + data).split(b"\n")
+        for line in lines:
+            self._add_line(line)
+
+    def dump(self, path: str) -> bool:
+        """Write the index, returns False if the file was too large to index"""
+        if self.overflowed:
+            return False
+        if self._tail:
+            self._add_line(self._tail)
+            self._tail = b""
+        keys = sorted(self.postings)
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, len(keys)))
+            first = 0
+            for trigram in keys:
+                count = len(self.postings[trigram])
+                file.write(ENTRY.pack(_key(trigram), first, count))
+                first += count
+            for trigram in keys:
+                self.postings[trigram].tofile(file)
+        return True
+
+
+def _postings(index: mmap.mmap, count: int, key: int) -> array:
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        found, first, size = ENTRY.unpack_from(index, HEADER.size + middle * ENTRY.size)
+        if found == key:
+            begin = HEADER.size + count * ENTRY.size + first * 4
+            lines = array("I")
+            lines.frombytes(index[begin:begin + size * 4])
+            return lines
+        if found < key:
+            low = middle + 1
+        else:
+            high = middle
+    return array("I")
+
+
+def candidates(path: str, pattern: bytes, start: int, stop: int) -> list[int]:
+    """Lines in ``start``..``stop`` that may contain ``pattern``
+
+    ``pattern`` must be at least three bytes long.
+    """
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as index:
+        magic, count = HEADER.unpack_from(index)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a trigram index")
+        keys = {_key(trigram) for trigram in zip(pattern, pattern[1:], pattern[2:])}
+        lists = sorted((_postings(index, count, key) for key in keys), key=len)
+
+    smallest = lists[0]
+    result = smallest[bisect_left(smallest, start):bisect_right(smallest, stop)]
+    for lines in lists[1:]:
+        if not result:
+            break
+        present = set(lines[bisect_left(lines, result[0]):bisect_right(lines, result[-1])])
+        result = [number for number in result if number in present]
+    return list(result)
@@ -4,6 +4,7 @@ import datetime
 import logging
 import math
 import os
+import re
 import time
 from fnmatch import fnmatch
 from math import ceil
@@ -12,22 +13,26 @@ from flask import Flask, request
 from flask import render_template, redirect
 from flask_login import login_user, LoginManager, login_required, logout_user, current_user
 from flask_restful import Api, abort
-from gevent import monkey
+from apscheduler.schedulers.gevent import GeventScheduler
+from gevent import get_hub, monkey
+from gevent.event import AsyncResult
+from gevent.threadpool import ThreadPool
 from gevent.pywsgi import WSGIServer
-from markupsafe import Markup
+from markupsafe import Markup, escape
 from requests import get, post, delete, put, patch
 from werkzeug.utils import secure_filename
 
 from data import db_session
 from data.document_service import DocumentResource, DocumentListResource
 from data.logs_service import LogsListResource
-from data.server_service import ServerResource, ServerListResource
+from data.server_service import ServerResource, ServerListResource, HandoffResource
 from data.user_service import UserResource, UserListResource
 from forms.ServerForm import AddServerForm
 from forms.SignUpForm import SignUpForm, LoginForm, EditUserForm, AdminEditUserForm
 from models.users import User
 from models.versions import Versions
-from storage_communication import manage
+from placement import HashRing, server_key
+from storage_communication import SearchError, add_sharded, delete_sharded, find_sharded, get_sharded, manage
 
 monkey.patch_all()
 app = Flask(__name__)
@@ -36,6 +41,34 @@ login_manager = LoginManager(app)
 login_manager.init_app(app)
 app.config['SECRET_KEY'] = 'prev_prof_lovers_secret_key'
 app.config['UPLOAD_FOLDER'] = './files'
+# Found lines are shown cut to this many characters around the match
+SNIPPET_WIDTH = 300
+# Servers holding every line-aligned segment of a new document, the documents
+# are then sharded over the servers; 0 keeps a full copy on every server
+SHARD_COPIES = 0
+# Parity shards of a new document, which is then erasure coded into data shards
+# for the other servers and survives the loss of this many of them; 0 turns
+# erasure coding off. Takes precedence over SHARD_COPIES
+PARITY_SHARDS = 0
+# Servers keeping a copy of a document, picked on a consistent hash ring so
+# that adding or removing a server moves few documents; 0 copies every
+# document to every server
+REPLICATION_FACTOR = 0
+# Replicas that must take an upload before it returns, the others get it later
+# by hinted handoff from one that took it; 0 waits for every replica
+QUORUM = 0
+# Failed handoffs are tried again after a delay doubling from HANDOFF_DELAY up
+# to HANDOFF_MAX_DELAY seconds, the queue is looked at every HANDOFF_INTERVAL
+HANDOFF_DELAY = 5
+HANDOFF_MAX_DELAY = 600
+HANDOFF_INTERVAL = 5
+# Requests to storages run on one event loop in a native thread, off the gevent
+# hub: calls of all web requests and of the handoff overlap on it, and the
+# connections to the storages stay open between them
+STORAGE_THREAD = ThreadPool(1)
+# Created in its thread, so that it waits for I/O there
+STORAGE_LOOP = STORAGE_THREAD.apply(asyncio.new_event_loop)
+STORAGE_THREAD.spawn(STORAGE_LOOP.run_forever)
 
 
 @app.errorhandler(404)
@@ -218,6 +251,172 @@ def user_profile(user_id):
     )
 
 
+def store_sharded(file_id: int, name_of_document: str, servers: list[dict], segments: int, parity: int = 0,
+                  file_folder: str = "./files/"):
+    """Upload a document as segments, or erasure coded shards if ``parity`` is set,
+    spread over the servers and record where they are kept"""
+    placement = storage(add_sharded(
+        servers,
+        file_id,
+        name_of_document,
+        file_folder,
+        segments,
+        parity,
+        copies=SHARD_COPIES or 1
+    ))
+    for record in placement:
+        if record["status"] == "OK":
+            post('http://localhost:5000/api/servers', json={
+                "file_id": file_id,
+                "host": record["host"],
+                "port": record["port"],
+                "segment": record["segment"],
+                "first_line": record["first_line"],
+                "last_line": record["last_line"]
+            }, timeout=(2, 20))
+
+
+def storage(coroutine):
+    """Result of a storage_communication coroutine run on STORAGE_LOOP
+
+    Only the calling greenlet waits: the loop thread wakes the hub through an
+    async watcher, which is started before the coroutine can finish.
+    """
+    done, watcher = AsyncResult(), get_hub().loop.async_()
+    watcher.start(done.set)
+    try:
+        future = asyncio.run_coroutine_threadsafe(coroutine, STORAGE_LOOP)
+        future.add_done_callback(lambda _: watcher.send())
+        done.get()
+    finally:
+        watcher.close()
+    return future.result()
+
+
+def highlight(text: str, pattern: re.Pattern | None) -> Markup:
+    """``text`` with the matches of ``pattern`` marked, everything else escaped"""
+    pieces, end = [], 0
+    for match in pattern.finditer(text) if pattern else ():
+        pieces += [escape(text[end:match.start()]), Markup("<mark>{}</mark>").format(match.group())]
+        end = match.end()
+    pieces.append(escape(text[end:]))
+    return Markup("").join(pieces)
+
+
+def replicas(file_id: int, servers: list[dict]) -> list[dict]:
+    """Servers that keep a copy of a document"""
+    if not REPLICATION_FACTOR:
+        return servers
+    return HashRing(servers).replicas(file_id, REPLICATION_FACTOR)
+
+
+def record_uploads(file_id: int, result: dict[str, str]) -> str:
+    """Mark the servers that took a document as up to date, queue handoffs for the others once a quorum took it
+
+    :param result: upload statuses by "host:port"
+    :return: error to show if fewer servers than the write quorum took the document
+    """
+    needed, succeeded = min(QUORUM, len(result)), list(result.values()).count("OK")
+    if succeeded < needed:
+        logging.error(f"Only {succeeded} of {needed} servers needed took document {file_id}, no handoff queued")
+    for v, k in result.items():
+        if k == "OK" or QUORUM and succeeded >= needed:
+            post('http://localhost:5000/api/servers', json={
+                "file_id": file_id,
+                "host": v.split(":")[0],
+                "port": int(v.split(":")[1]),
+                "pending": k != "OK"
+            }, timeout=(2, 20))
+    if succeeded < needed:
+        return f"Файл сохранён на {succeeded} из {needed} серверов, нужных для записи"
+    return ''
+
+
+def handoff():
+    """Copy documents to the servers that missed them in a quorum write, from a server that is up to date"""
+    hints = get('http://localhost:5000/api/handoff', timeout=(2, 20)).json()['hints']
+    moves, failed = [], []
+    for hint in hints:
+        holders = get('http://localhost:5000/api/servers', json={'file_id': hint['file_id']}, timeout=(2, 20)).json()['servers']
+        if holders:
+            moves.append({"id": hint['file_id'], "source": holders[0],
+                          "target": {"host": hint['host'], "port": hint['port']}, "attempts": hint['attempts']})
+        else:
+            failed.append(hint)
+
+    statuses = storage(manage("move", files=moves)) if moves else []
+    for move, status in zip(moves, statuses):
+        if status == "OK":
+            post('http://localhost:5000/api/servers', json={
+                "file_id": move['id'],
+                "host": move['target']['host'],
+                "port": move['target']['port']
+            }, timeout=(2, 20))
+        else:
+            failed.append({"file_id": move['id'], **move['target'], "attempts": move['attempts']})
+    for hint in failed:
+        put('http://localhost:5000/api/handoff', json={
+            "file_id": hint['file_id'],
+            "host": hint['host'],
+            "port": hint['port'],
+            "delay": min(HANDOFF_DELAY * 2 ** hint['attempts'], HANDOFF_MAX_DELAY)
+        }, timeout=(2, 20))
+    if hints:
+        logging.info(f"Handoff: {statuses.count('OK')} of {len(hints)} copies done")
+
+
+def rebalance(before: list[dict], after: list[dict]):
+    """Move the copies of documents whose replicas change when the servers change from ``before`` to ``after``
+
+    A server gaining a document gets it straight from a server holding it, a
+    server losing a document drops it once the document reached all servers
+    gaining it.
+    """
+    old, new = HashRing(before), HashRing(after)
+    documents = get('http://localhost:5000/api/documents', json={
+        'owner_id': 0, 'name': '', 'size': 0, 'number_of_lines': 0}, timeout=(2, 20)).json()['documents']
+    moves, losses = [], {}
+    for doc in documents:
+        if doc.get('segments'):
+            continue
+        gained, lost = old.moves(new, doc['id'], REPLICATION_FACTOR)
+        if not gained and not lost:
+            continue
+        holders = get('http://localhost:5000/api/servers', json={'file_id': doc['id']}, timeout=(2, 20)).json()['servers']
+        # Prefer holders that stay, a server being removed may be down
+        sources = [s for s in holders if server_key(s) in new.servers] or holders
+        if not sources:
+            continue
+        moves += [{"id": doc['id'], "source": sources[0], "target": server} for server in gained]
+        losses[doc['id']] = lost
+
+    statuses = storage(manage("move", files=moves)) if moves else []
+    for move, status in zip(moves, statuses):
+        if status == "OK":
+            post('http://localhost:5000/api/servers', json={
+                "file_id": move['id'],
+                "host": move['target']['host'],
+                "port": move['target']['port']
+            }, timeout=(2, 20))
+        else:
+            losses.pop(move['id'], None)
+
+    dropped = {}
+    for file_id, lost in losses.items():
+        for server in lost:
+            dropped.setdefault(server_key(server), (server, []))[1].append({"id": file_id})
+    for server, files in dropped.values():
+        storage(manage("remove", storages=[server], files=files))
+        for file in files:
+            delete('http://localhost:5000/api/servers', json={
+                "file_id": file['id'],
+                "host": server['host'],
+                "port": server['port']
+            }, timeout=(2, 20))
+    logging.info(f"Rebalanced: {statuses.count('OK')} of {len(moves)} copies moved, "
+                 f"{sum(len(files) for _, files in dropped.values())} dropped")
+
+
 @app.route('/user_table_files/<int:user_id>', methods=['GET', 'POST'])
 @login_required
 def user_table_files(user_id):
@@ -240,17 +439,27 @@ def user_table_files(user_id):
     if current_user.id != user_id:
         return abort(404)
 
+    message = ''
     if request.method == 'POST':
         try:
             document = request.files['file']
             name_of_document = secure_filename(document.filename)
             document.save(f'./files/{name_of_document}')
+            servers = get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers']
             with open(f'./files/{name_of_document}', 'r', encoding='utf-8') as file:
+                number_of_lines = len(file.readlines())
+                parity = PARITY_SHARDS if len(servers) > PARITY_SHARDS else 0
+                if parity:
+                    segments = max(min(len(servers) - parity, number_of_lines), 1)
+                else:
+                    segments = min(len(servers), number_of_lines) if SHARD_COPIES else 0
                 doc = post('http://localhost:5000/api/documents', json={
                     'name': name_of_document,
                     'owner_id': user_id,
                     'size': os.path.getsize(f'./files/{name_of_document}'),
-                    'number_of_lines': len(file.readlines())},
+                    'number_of_lines': number_of_lines,
+                    'segments': segments,
+                    'parity': parity},
                            timeout=(2, 20)).json()['document']
                 post('http://localhost:5000/api/log', json={
                     'type': 5,
@@ -260,21 +469,19 @@ def user_table_files(user_id):
                     'description': f'Добавление файла: {name_of_document}'},
                      timeout=(2, 20))
 
-            result = asyncio.run(manage(
-                "add",
-                doc['id'],
-                name_of_document,
-                get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers'],
-                file_folder="./files/"
-            ))
+            if segments:
+                store_sharded(doc['id'], name_of_document, servers, segments, parity)
+            else:
+                result = storage(manage(
+                    "add",
+                    doc['id'],
+                    name_of_document,
+                    replicas(doc['id'], servers),
+                    file_folder="./files/",
+                    quorum=QUORUM
+                ))
 
-            for v, k in result.items():
-                if k == "OK":
-                    post('http://localhost:5000/api/servers', json={
-                        "file_id": doc['id'],
-                        "host": v.split(":")[0],
-                        "port": int(v.split(":")[1])
-                    }, timeout=(2, 20))
+                message = record_uploads(doc['id'], result)
             os.remove(f'./files/{name_of_document}')
         except PermissionError:
             pass
@@ -339,6 +546,7 @@ def user_table_files(user_id):
         prev=prev_p,
         username=current_user.login,
         search=search,
+        message=message,
     )
 
 
@@ -352,7 +560,7 @@ def server_table():
         search = request.args.get("search", "*")
         search = "*" + search + "*"
         servers = list(filter(lambda x: fnmatch(x["name"], search), iter(servers)))
-        servers_ping = asyncio.run(manage(
+        servers_ping = storage(manage(
             "ping", storages=servers
         ))
         for server in servers:
@@ -473,12 +681,16 @@ def delete_file(file_id):
             'description': f'Удаление файла: {document["document"]["name"]}'},
              timeout=(2, 20))
         delete(f'http://localhost:5000/api/documents/{file_id}', timeout=(2, 20))
-        asyncio.run(manage(
-            "delete",
-            file_id,
-            document['document']['name'],
-            get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers']
-        ))
+        servers = get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers']
+        if document['document'].get('segments'):
+            storage(delete_sharded(
+                servers,
+                file_id,
+                document['document']['segments'],
+                document['document'].get('parity') or 0
+            ))
+        else:
+            storage(manage("delete", file_id, document['document']['name'], servers))
         return redirect(f'/user_table_files/{current_user.id}')
     return abort(404)
 
@@ -493,25 +705,31 @@ def add_server():
         form = AddServerForm()
         if request.method == 'POST':
             if form.validate_on_submit():
-                free, total = asyncio.run(manage(
+                free, total, *_ = storage(manage(
                     "info", 0, "", [],
                     storage={"host": form.address.data, "port": int(form.port.data)}
                 ))
 
+                servers = get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers']
                 serv = post('http://localhost:5000/api/servers', json={
                     'name': form.name.data,
                     'host': form.address.data,
                     'port': form.port.data,
                     'capacity': total // (2 ** 30),
-                    'ended_capacity': free // (2 ** 30)
+                    'ended_capacity': free // (2 ** 30),
+                    'copy_documents': not REPLICATION_FACTOR
                 }, timeout=(2, 20)).json()['server']
 
-                asyncio.run(manage(
-                    "copy",
-                    storages=get('http://localhost:5000/api/servers',
-                                 json={'file_id': -1}, timeout=(2, 20)).json()['servers'],
-                    storage={"host": form.address.data, "port": int(form.port.data)}
-                ))
+                if REPLICATION_FACTOR:
+                    # The new server only gets the documents it is now a replica of
+                    rebalance(servers, servers + [serv])
+                else:
+                    storage(manage(
+                        "copy",
+                        storages=get('http://localhost:5000/api/servers',
+                                     json={'file_id': -1}, timeout=(2, 20)).json()['servers'],
+                        storage={"host": form.address.data, "port": int(form.port.data)}
+                    ))
 
                 post('http://localhost:5000/api/log', json={
                     'type': 8,
@@ -537,17 +755,21 @@ def delete_server(server_id):
     :param server_id: id of storage in base
     """
     if current_user.admin == 1:
-        storage = get(f'http://localhost:5000/api/servers/{server_id}',
-                      timeout=(2, 20)).json()['server']
-        asyncio.run(manage(
-            "end", -1, "", [], storage=storage
+        server = get(f'http://localhost:5000/api/servers/{server_id}',
+                     timeout=(2, 20)).json()['server']
+        if REPLICATION_FACTOR:
+            # Other servers take over the copies the server kept
+            servers = get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers']
+            rebalance(servers, [s for s in servers if s['id'] != server_id])
+        storage(manage(
+            "end", -1, "", [], storage=server
         ))
         post('http://localhost:5000/api/log', json={
             'type': 9,
             'time': datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S'),
             'object_id': server_id,
             'owner_id': current_user.get_id(),
-            'description': f"Удаление сервера: {storage['name']}"},
+            'description': f"Удаление сервера: {server['name']}"},
              timeout=(2, 20))
         delete(f'http://localhost:5000/api/servers/{server_id}', timeout=(2, 20))
         return redirect('/admin_server_table')
@@ -649,7 +871,7 @@ def delete_user(user_id):
         for file in files:
             delete(f'http://localhost:5000/api/documents/{file["id"]}', timeout=(2, 20))
         delete(f'http://localhost:5000/api/users/{user_id}', timeout=(2, 20))
-        asyncio.run(manage(
+        storage(manage(
             "remove", storages=storages, files=files
         ))
         return redirect('/admin_user_table')
@@ -662,7 +884,7 @@ def edit_document(file_id):
     doc = get(f'http://localhost:5000/api/documents/{file_id}', timeout=(2, 20)).json()['document']
     if doc["owner_id"] != current_user.id and current_user.admin != 1:
         return abort(404)
-    lines = [-1]
+    lines, message = [-1], ''
     if request.method == 'POST':
         try:
             document = request.files['file']
@@ -678,21 +900,20 @@ def edit_document(file_id):
                       timeout=(2, 20))
 
 
-            result = asyncio.run(manage(
-                "add",
-                doc['id'],
-                name_of_document,
-                get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers'],
-                file_folder="./files/"
-            ))
+            servers = get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers']
+            if doc.get('segments'):
+                store_sharded(doc['id'], name_of_document, servers, doc['segments'], doc.get('parity') or 0)
+            else:
+                result = storage(manage(
+                    "patch",
+                    doc['id'],
+                    name_of_document,
+                    replicas(doc['id'], servers),
+                    file_folder="./files/",
+                    quorum=QUORUM
+                ))
 
-            for v, k in result.items():
-                if k == "OK":
-                    post('http://localhost:5000/api/servers', json={
-                        "file_id": doc['id'],
-                        "host": v.split(":")[0],
-                        "port": int(v.split(":")[1])
-                    }, timeout=(2, 20))
+                message = record_uploads(doc['id'], result)
             os.remove(f'./files/{name_of_document}')
 
         except PermissionError:
@@ -710,61 +931,99 @@ def edit_document(file_id):
                     'size': os.path.getsize(f'./files/local/{doc["name"]}'),
                     'number_of_lines': len(file.readlines())},
                       timeout=(2, 20))
-            result = asyncio.run(manage(
-                "add", doc['id'], doc['name'],
-                get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers'],
-                file_folder="./files/local/"
-            ))
-            for v, k in result.items():
-                if k == "OK":
-                    post('http://localhost:5000/api/servers', json={
-                        "file_id": doc['id'],
-                        "host": v.split(":")[0],
-                        "port": int(v.split(":")[1])
-                    }, timeout=(2, 20))
+            servers = get('http://localhost:5000/api/servers', json={}, timeout=(2, 20)).json()['servers']
+            if doc.get('segments'):
+                store_sharded(doc['id'], doc['name'], servers, doc['segments'], doc.get('parity') or 0,
+                              file_folder="./files/local/")
+            else:
+                result = storage(manage(
+                    "patch", doc['id'], doc['name'],
+                    replicas(doc['id'], servers),
+                    file_folder="./files/local/",
+                    quorum=QUORUM
+                ))
+                message = record_uploads(doc['id'], result)
 
-    logging.info(get('http://localhost:5000/api/servers', json={'file_id': doc['id']}, timeout=(2, 20)).json())
+    holders = get('http://localhost:5000/api/servers', json={'file_id': doc['id']}, timeout=(2, 20)).json()
+    logging.info(holders)
+    # Where the segments of a sharded document are, None for a fully copied one
+    placement = holders['placement'] if doc.get('segments') else None
 
     if int(doc['size']) < 1024 * 1024 * 100:
-        asyncio.run(manage(
-            "get", file_id, doc['name'],
-            get('http://localhost:5000/api/servers', json={'file_id': doc['id']}, timeout=(2, 20)).json()['servers'],
-            destination_folder=os.path.join('files', 'local')
-        ))
+        if placement is None:
+            storage(manage(
+                "get", file_id, doc['name'],
+                holders['servers'],
+                destination_folder=os.path.join('files', 'local')
+            ))
+        else:
+            storage(get_sharded(
+                placement, file_id, doc['name'],
+                os.path.join('files', 'local'),
+                doc['segments'],
+                doc.get('parity') or 0
+            ))
         with open(os.path.join(os.path.join('files', 'local'), doc['name'])) as file:
             text = file.read()
     else:
         text = "Файл слишком большой, чтобы отобразить его полностью"
 
-    time_delta = 0
+    time_delta, search_error = 0, None
     if request.method == 'GET':
         if request.args.get("substr") is not None:
             substr = request.args.get("substr")
+            regex = request.args.get("regex") is not None
+            ignore_case = request.args.get("ignore_case") is not None
+            whole_word = request.args.get("whole_word") is not None
             tm = time.time()
-            find_result = asyncio.run(manage(
-                "find",
-                file_id,
-                doc['name'],
-                get('http://localhost:5000/api/servers', json={'file_id': doc['id']}, timeout=(2, 20)).json()[
-                    'servers'],
-                substring=substr,
-                lines=doc['number_of_lines'],
-            ))
+            try:
+                if placement is None:
+                    find_result = storage(manage(
+                        "find",
+                        file_id,
+                        doc['name'],
+                        holders['servers'],
+                        substring=substr,
+                        lines=doc['number_of_lines'],
+                        regex=regex,
+                        ignore_case=ignore_case,
+                        whole_word=whole_word,
+                        snippet=SNIPPET_WIDTH,
+                    )) or {}
+                else:
+                    find_result = storage(find_sharded(
+                        placement,
+                        file_id,
+                        substr,
+                        regex=regex,
+                        ignore_case=ignore_case,
+                        whole_word=whole_word,
+                        snippet=SNIPPET_WIDTH,
+                    ))
+            except SearchError as er:
+                # An invalid regular expression or a search over its time budget
+                find_result, search_error = {}, f"Поиск не выполнен: {er}"
+            except ConnectionRefusedError:
+                # A server holding a segment is down
+                find_result, search_error = {}, "Поиск не выполнен: сервер недоступен"
             time_delta = time.time() - tm
             logging.info(f"TOTAL {time_delta}")
+            # The nodes send the text of the found lines along with their numbers
             rows = sorted(find_result)
-            if int(doc['size']) < 1024 * 1024 * 100:
-                with open(f'./files/local/{doc["name"]}') as file:
-                    lines = file.readlines()
-
-                # Apply row mask
-                lines = [[i, substr,
-                          Markup(f'<mark>{substr}</mark>'.join(lines[i - 1].split(substr)))]
-                         for i in rows]
-            else:
-                lines = [[i, "", Markup('<small class="text-body-secondary">'
-                                        'Строка слишком большая, чтобы отобразить её полностью'
-                                        '</small>')] for i in rows]
+            row_text = find_result
+
+            # Apply row mask
+            pattern = None
+            if rows:
+                pattern = substr if regex else re.escape(substr)
+                if whole_word:
+                    pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+                try:
+                    pattern = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+                except re.error:
+                    # Nothing to highlight with, the lines are shown as they are
+                    pattern = None
+            lines = [[i, substr, highlight(row_text.get(i, ''), pattern)] for i in rows]
     if int(doc['size']) < 1024 * 1024 * 100:
         os.remove(f'./files/local/{doc["name"]}')
 
@@ -779,11 +1038,13 @@ def edit_document(file_id):
     return render_template(
         page,
         time_delta=round(time_delta, 2),
-        filename=Markup(f"<b>{doc['name']}</b>"),
+        filename=Markup("<b>{}</b>").format(doc['name']),
         user_id=current_user.id,
         username=current_user.login,
         findlines=lines,
         showtable=showtable,
+        search_error=search_error,
+        message=message,
         text=text,
     )
 
@@ -904,7 +1165,17 @@ if __name__ == '__main__':
     api.add_resource(DocumentResource, '/api/documents/<int:document_id>')
     api.add_resource(ServerListResource, '/api/servers')
     api.add_resource(ServerResource, '/api/servers/<int:server_id>')
+    api.add_resource(HandoffResource, '/api/handoff')
     db_session.global_init("data/data.db")
+    scheduler = GeventScheduler()
+    scheduler.add_job(handoff, 'interval', seconds=HANDOFF_INTERVAL, max_instances=1)
+    scheduler.start()
     # app.run(debug=True, host='0.0.0.0')
     http = WSGIServer(('0.0.0.0', 5000), app.wsgi_app)
-    http.serve_forever()
+    try:
+        http.serve_forever()
+    finally:
+        # Idle worker threads would keep the process from exiting
+        scheduler.shutdown(wait=False)
+        STORAGE_LOOP.call_soon_threadsafe(STORAGE_LOOP.stop)
+        STORAGE_THREAD.kill()
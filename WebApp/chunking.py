@@ -0,0 +1,68 @@
+"""Content-defined chunking of uploads
+
+Mirrors ``Storage/chunks.py``: a chunk ends after a line whose CRC satisfies a
+size-scaled condition, so boundaries depend only on nearby content. Both sides
+must use the same parameters for storages to recognise chunks they already hold.
+"""
+import hashlib
+import zlib
+
+MIN_SIZE = 16 * 1024
+AVERAGE_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+
+
+class Chunker:
+    """Splits a stream fed piece by piece into content-defined chunks"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    def _cut(self, size: int) -> bytes:
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._scanned = max(self._scanned - size, 0)
+        return chunk
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """Add data, returns the chunks it completed"""
+        self._buffer += data
+        chunks = []
+        while True:
+            newline = self._buffer.find(b"\n", self._scanned)
+            end = newline + 1
+            if newline < 0 or end > MAX_SIZE:
+                if len(self._buffer) < MAX_SIZE:
+                    break
+                # No line end fits: cut before the long line or inside it
+                chunks.append(self._cut(self._scanned if self._scanned >= MIN_SIZE else MAX_SIZE))
+                continue
+            line = self._buffer[self._scanned:end]
+            self._scanned = end
+            if end >= MIN_SIZE and zlib.crc32(line) % AVERAGE_SIZE < len(line):
+                chunks.append(self._cut(end))
+        return chunks
+
+    def finish(self) -> list[bytes]:
+        """The remaining data as the last chunk"""
+        return [self._cut(len(self._buffer))] if self._buffer else []
+
+
+def chunk_file(path: str, batch_size: int = 1 << 20) -> list[tuple[str, int, int]]:
+    """Split a file into chunks
+
+    :param path: path to file
+    :return: sha256 hex digest, offset and size of every chunk
+    """
+    chunker = Chunker()
+    result = []
+    offset = 0
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(batch_size)
+            for chunk in chunker.feed(data) if data else chunker.finish():
+                result.append((hashlib.sha256(chunk).hexdigest(), offset, len(chunk)))
+                offset += len(chunk)
+            if not data:
+                return result
@@ -14,6 +14,8 @@ class DocumentResource(Resource):
         self.parser.add_argument('owner_id', required=True)
         self.parser.add_argument('size', required=True)
         self.parser.add_argument('number_of_lines', required=True)
+        self.parser.add_argument('segments', required=False, type=int)
+        self.parser.add_argument('parity', required=False, type=int)
 
     def get(self, document_id):
         document = self.session.query(Document).get(document_id)
@@ -40,6 +42,10 @@ class DocumentResource(Resource):
         doc.owner_id = args['owner_id']
         doc.size = args['size']
         doc.number_of_lines = args['number_of_lines']
+        if args['segments'] is not None:
+            doc.segments = args['segments']
+        if args['parity'] is not None:
+            doc.parity = args['parity']
         doc.version += 1
         self.session.commit()
         return jsonify({'status': 'OK'})
@@ -54,6 +60,8 @@ class DocumentListResource(Resource):
         self.parser.add_argument('size', required=True)
         self.parser.add_argument('number_of_lines', required=True)
         self.parser.add_argument('flag', required=False)
+        self.parser.add_argument('segments', required=False, type=int)
+        self.parser.add_argument('parity', required=False, type=int)
 
     def get(self):
         args = self.parser.parse_args()
@@ -72,6 +80,8 @@ class DocumentListResource(Resource):
             owner_id=args['owner_id'],
             size=args['size'],
             number_of_lines=args['number_of_lines'],
+            segments=args['segments'] or 0,
+            parity=args['parity'] or 0,
         )
         self.session.add(document)
         self.session.commit()
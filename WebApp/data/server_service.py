@@ -1,3 +1,5 @@
+import datetime
+
 from flask import jsonify
 from flask_restful import Resource, reqparse
 
@@ -52,6 +54,13 @@ class ServerListResource(Resource):
         self.parser.add_argument('ended_capacity', required=False)
         self.parser.add_argument('capacity', required=False)
         self.parser.add_argument('file_id', required=False)
+        self.parser.add_argument('segment', required=False, type=int)
+        self.parser.add_argument('first_line', required=False, type=int)
+        self.parser.add_argument('last_line', required=False, type=int)
+        # False when the documents a new server receives are recorded one by one
+        self.parser.add_argument('copy_documents', required=False, type=bool, default=True)
+        # True when the server did not take the document yet and gets it by hinted handoff
+        self.parser.add_argument('pending', required=False, type=bool, default=False)
 
     def get(self):
         args = self.parser.parse_args()
@@ -62,14 +71,23 @@ class ServerListResource(Resource):
         if args['file_id'] != "-1":
             doc = self.session.query(Document).filter(Document.id == args['file_id']).first()
             versions = self.session.query(Versions).filter(Versions.file_id == args['file_id']).filter(Versions.current_version == doc.version).all()
-            servers = [
-                self.session.query(Server).filter(Server.id == v.server_id).first().to_dict()
-                for v in versions
-            ]
-            return jsonify({'servers': servers})
+            servers, placement = {}, []
+            for v in versions:
+                server = servers.setdefault(
+                    v.server_id, self.session.query(Server).filter(Server.id == v.server_id).first().to_dict())
+                if v.segment is not None:
+                    placement.append({
+                        'host': server['host'],
+                        'port': server['port'],
+                        'segment': v.segment,
+                        'first_line': v.first_line,
+                        'last_line': v.last_line,
+                    })
+            return jsonify({'servers': list(servers.values()), 'placement': placement})
         servers = []
         for s in self.session.query(Server).all():
-            versions = self.session.query(Versions).filter(Versions.server_id == s.id).all()
+            # Segments of sharded documents are not copied to new servers
+            versions = self.session.query(Versions).filter(Versions.server_id == s.id).filter(Versions.segment.is_(None)).all()
             for v in versions:
                 d = self.session.query(Document).get(v.file_id)
                 if d is None:
@@ -93,8 +111,10 @@ class ServerListResource(Resource):
                 capacity=args['capacity'],
             )
             self.session.add(server)
-            doc = self.session.query(Document).all()
+            doc = self.session.query(Document).all() if args['copy_documents'] else []
             for d in doc:
+                if d.segments:
+                    continue
                 ver = Versions(
                     server_id=server.id,
                     file_id=d.id,
@@ -105,13 +125,77 @@ class ServerListResource(Resource):
             return jsonify({'server': server.to_dict()})
         server = self.session.query(Server).filter(Server.host == args['host']).filter(Server.port == args['port']).first()
         doc = self.session.query(Document).filter(Document.id == args['file_id']).first()
-        ver = self.session.query(Versions).filter(Versions.file_id == args['file_id']).filter(Versions.server_id == server.id).first()
+        ver = self.session.query(Versions).filter(Versions.file_id == args['file_id']).filter(Versions.server_id == server.id).filter(
+            Versions.segment.is_(None) if args['segment'] is None else Versions.segment == args['segment']).first()
         if ver is None:
             ver = Versions(
                 server_id=server.id,
                 file_id=args['file_id'],
-                current_version=0
+                current_version=0,
+                segment=args['segment']
             )
             self.session.add(ver)
+        if args['pending']:
+            if ver.handoff_at is None:
+                ver.handoff_at = datetime.datetime.now()
+                ver.handoff_attempts = 0
+            self.session.commit()
+            return jsonify({'status': 'OK'})
         ver.current_version = doc.version
+        ver.first_line = args['first_line']
+        ver.last_line = args['last_line']
+        ver.handoff_at = None
+        ver.handoff_attempts = 0
         self.session.commit()
+
+    def delete(self):
+        """Forget that the server at host and port holds the document file_id"""
+        args = self.parser.parse_args()
+        server = self.session.query(Server).filter(Server.host == args['host']).filter(Server.port == args['port']).first()
+        if server is not None:
+            for v in self.session.query(Versions).filter(Versions.file_id == args['file_id']).filter(Versions.server_id == server.id).all():
+                self.session.delete(v)
+            self.session.commit()
+        return jsonify({'status': 'OK'})
+
+
+class HandoffResource(Resource):
+    """Queue of servers to bring up to date with a document, kept in the versions table"""
+
+    def __init__(self):
+        self.session = db_session.create_session()
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument('file_id', required=True, type=int)
+        self.parser.add_argument('host', required=True)
+        self.parser.add_argument('port', required=True)
+        self.parser.add_argument('delay', required=True, type=float)
+
+    def get(self):
+        """Handoffs due now"""
+        hints = []
+        for v in self.session.query(Versions).filter(Versions.handoff_at <= datetime.datetime.now()).all():
+            doc = self.session.query(Document).get(v.file_id)
+            server = self.session.query(Server).get(v.server_id)
+            if doc is None or server is None or v.current_version == doc.version:
+                v.handoff_at = None
+                continue
+            hints.append({
+                'file_id': v.file_id,
+                'host': server.host,
+                'port': server.port,
+                'attempts': v.handoff_attempts or 0,
+            })
+        self.session.commit()
+        return jsonify({'hints': hints})
+
+    def put(self):
+        """Try a failed handoff again after delay seconds"""
+        args = self.parser.parse_args()
+        server = self.session.query(Server).filter(Server.host == args['host']).filter(Server.port == args['port']).first()
+        ver = self.session.query(Versions).filter(Versions.file_id == args['file_id']).filter(
+            Versions.server_id == server.id).filter(Versions.segment.is_(None)).first()
+        if ver is not None:
+            ver.handoff_attempts = (ver.handoff_attempts or 0) + 1
+            ver.handoff_at = datetime.datetime.now() + datetime.timedelta(seconds=args['delay'])
+            self.session.commit()
+        return jsonify({'status': 'OK'})
@@ -0,0 +1,98 @@
+"""Delta of an edited document against block signatures of its stored version
+
+Mirrors the checksums of ``Storage/delta.py``, the instruction format is
+described there.
+"""
+import hashlib
+import struct
+from itertools import accumulate
+from typing import Iterator
+
+U32 = struct.Struct("!I")
+COPY, LITERAL, END = b"C", b"L", b"E"
+MODULUS = 1 << 16
+LITERAL_SIZE = 1024 * 1024
+# Past this share of new bytes an upload by chunks is cheaper than the delta,
+# checked once a few blocks have been scanned
+MAX_LITERAL_SHARE = 0.5
+MIN_SCANNED_BLOCKS = 16
+
+
+class TooDifferent(Exception):
+    """The data shares too little with the stored version for a delta to pay off"""
+
+
+def weak_checksum(block: bytes) -> tuple[int, int]:
+    return sum(block) % MODULUS, sum(accumulate(block)) % MODULUS
+
+
+def strong_hash(block: bytes) -> str:
+    return hashlib.sha256(block).hexdigest()[:32]
+
+
+def _literal(data: bytes, start: int, stop: int) -> Iterator[bytes]:
+    for begin in range(start, stop, LITERAL_SIZE):
+        end = min(begin + LITERAL_SIZE, stop)
+        yield LITERAL + U32.pack(end - begin)
+        yield data[begin:end]
+
+
+def make_delta(data: bytes, signature: dict, max_literal_share: float | None = None) -> Iterator[bytes]:
+    """Instructions rebuilding ``data`` from the blocks of the stored version
+
+    A window of ``block_size`` bytes slides over the data one byte at a time
+    while it matches no block, its weak checksum is updated in constant time.
+    After a match the window jumps past the copied block.
+
+    :param max_literal_share: raise TooDifferent as soon as more than this share
+        of the scanned data has to be sent as literals
+    """
+    block_size, blocks = signature["block_size"], signature["blocks"]
+    if not blocks:
+        if max_literal_share is not None and data:
+            raise TooDifferent
+        yield from _literal(data, 0, len(data))
+        yield END + hashlib.sha256(data).digest()
+        return
+    full = signature["size"] // block_size
+    candidates = {}
+    for index, (weak, strong) in enumerate(blocks[:full]):
+        candidates.setdefault(weak, {}).setdefault(strong, index)
+
+    size = len(data)
+    literal_start = position = literal = 0
+    min_scanned = MIN_SCANNED_BLOCKS * block_size
+    a = b = None
+    while position + block_size <= size:
+        if a is None:
+            a, b = weak_checksum(data[position:position + block_size])
+        strong_hashes = candidates.get(a | b << 16)
+        if strong_hashes is not None:
+            index = strong_hashes.get(strong_hash(data[position:position + block_size]))
+            if index is not None:
+                yield from _literal(data, literal_start, position)
+                yield COPY + U32.pack(index)
+                literal += position - literal_start
+                position = literal_start = position + block_size
+                a = None
+                continue
+        if position + block_size < size:
+            outgoing, incoming = data[position], data[position + block_size]
+            a = (a - outgoing + incoming) % MODULUS
+            b = (b - block_size * outgoing + a) % MODULUS
+        position += 1
+        if max_literal_share is not None and position >= min_scanned \
+                and literal + position - literal_start > max_literal_share * position:
+            raise TooDifferent
+
+    if full < len(blocks):
+        # The shorter last block can only match the end of the data
+        start = size - (signature["size"] - full * block_size)
+        weak, strong = blocks[full]
+        if start >= literal_start and weak_checksum(data[start:]) == (weak & 0xFFFF, weak >> 16) \
+                and strong_hash(data[start:]) == strong:
+            yield from _literal(data, literal_start, start)
+            yield COPY + U32.pack(full)
+            literal_start = size
+    yield from _literal(data, literal_start, size)
+    yield END + hashlib.sha256(data).digest()
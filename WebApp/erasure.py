@@ -0,0 +1,98 @@
+"""Reed-Solomon erasure code over GF(2^8)
+
+A file cut into ``k`` data shards of the same size gets ``m`` parity shards,
+any ``k`` of the ``k + m`` shards rebuild the data. Shard ``i`` is row ``i`` of
+a generator matrix times the data shards: the identity for the data shards,
+which stay readable as they are, and a Cauchy matrix for the parity shards, so
+that any ``k`` rows of the generator form an invertible matrix.
+
+Products of bytes are looked up in a 256x256 table, multiplying a whole shard
+by a coefficient is one NumPy lookup in the table row. Shards are processed in
+blocks that stay in the CPU cache while every row is computed.
+"""
+import numpy as np
+
+POLYNOMIAL = 0x11D
+BLOCK_SIZE = 64 * 1024
+
+
+def _tables() -> tuple[np.ndarray, np.ndarray]:
+    exp = np.zeros(510, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.intp)
+    x = 1
+    for power in range(255):
+        exp[power] = x
+        log[x] = power
+        x <<= 1
+        if x & 0x100:
+            x ^= POLYNOMIAL
+    exp[255:] = exp[:255]
+    product = exp[log[:, None] + log[None, :]]
+    product[0, :] = product[:, 0] = 0
+    inverse = np.zeros(256, dtype=np.uint8)
+    inverse[1:] = exp[255 - log[1:]]
+    return product, inverse
+
+
+MUL, INV = _tables()
+
+
+def _cauchy(count: int, parity: int) -> np.ndarray:
+    """Rows of the parity shards: 1 / (x_j + y_i) with x_j = count + j, y_i = i"""
+    if count + parity > 256:
+        raise ValueError("At most 256 shards")
+    rows = np.arange(count, count + parity)[:, None] ^ np.arange(count)[None, :]
+    return INV[rows]
+
+
+def generator(count: int, parity: int) -> np.ndarray:
+    return np.vstack([np.eye(count, dtype=np.uint8), _cauchy(count, parity)])
+
+
+def _multiply(matrix: np.ndarray, shards: np.ndarray) -> np.ndarray:
+    result = np.zeros((len(matrix), shards.shape[1]), dtype=np.uint8)
+    for start in range(0, shards.shape[1], BLOCK_SIZE):
+        block = shards[:, start:start + BLOCK_SIZE]
+        for row, coefficients in zip(result[:, start:start + BLOCK_SIZE], matrix):
+            for coefficient, shard in zip(coefficients, block):
+                if coefficient:
+                    row ^= MUL[coefficient].take(shard)
+    return result
+
+
+def _invert(matrix: np.ndarray) -> np.ndarray:
+    """Gauss-Jordan elimination, the matrix must be invertible"""
+    size = len(matrix)
+    work = np.hstack([matrix, np.eye(size, dtype=np.uint8)])
+    for column in range(size):
+        pivot = column + int(np.flatnonzero(work[column:, column])[0])
+        work[[column, pivot]] = work[[pivot, column]]
+        work[column] = MUL[INV[work[column, column]]][work[column]]
+        for row in range(size):
+            if row != column and work[row, column]:
+                work[row] ^= MUL[work[row, column]][work[column]]
+    return work[:, size:]
+
+
+def _stack(shards: list[bytes]) -> np.ndarray:
+    return np.frombuffer(b"".join(shards), dtype=np.uint8).reshape(len(shards), -1)
+
+
+def encode(data: list[bytes], parity: int) -> list[bytes]:
+    """Parity shards of data shards of the same size"""
+    return [row.tobytes() for row in _multiply(_cauchy(len(data), parity), _stack(data))]
+
+
+def decode(shards: dict[int, bytes], count: int, parity: int) -> list[bytes]:
+    """Data shards rebuilt from any ``count`` shards
+
+    :param shards: shards by index, data shards come first
+    :param count: number of data shards
+    """
+    present = sorted(shards)[:count]
+    if len(present) < count:
+        raise ValueError(f"{count} shards needed, {len(present)} given")
+    if present == list(range(count)):
+        return [shards[index] for index in present]
+    inverse = _invert(generator(count, parity)[present])
+    return [row.tobytes() for row in _multiply(inverse, _stack([shards[index] for index in present]))]
@@ -17,4 +17,8 @@ class Document(SqlAlchemyBase, UserMixin, SerializerMixin):
     last_modified = sqlalchemy.Column(sqlalchemy.DATETIME, default=datetime.datetime.now, nullable=True)
     size = sqlalchemy.Column(sqlalchemy.String, nullable=True)
     number_of_lines = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
-    version = sqlalchemy.Column(sqlalchemy.Integer, nullable=True, default=1)
\ No newline at end of file
+    version = sqlalchemy.Column(sqlalchemy.Integer, nullable=True, default=1)
+    # Number of line-aligned segments the document is sharded into, 0 if every server has a full copy
+    segments = sqlalchemy.Column(sqlalchemy.Integer, nullable=True, default=0)
+    # Parity shards of an erasure coded document, its segments are then the data shards
+    parity = sqlalchemy.Column(sqlalchemy.Integer, nullable=True, default=0)
\ No newline at end of file
@@ -12,3 +12,10 @@ class Versions(SqlAlchemyBase, UserMixin, SerializerMixin):
     server_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("servers.id"))
     file_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("documents.id"))
     current_version = sqlalchemy.Column(sqlalchemy.Integer)
+    # Segment of a sharded document the server holds and its lines, empty for a full copy
+    segment = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+    first_line = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+    last_line = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+    # Next try to bring the server up to date by hinted handoff, empty if none is pending
+    handoff_at = sqlalchemy.Column(sqlalchemy.DATETIME, nullable=True)
+    handoff_attempts = sqlalchemy.Column(sqlalchemy.Integer, nullable=True, default=0)
@@ -0,0 +1,47 @@
+"""Consistent hashing of documents onto servers
+
+Every server owns ``VNODES`` points on a ring of 64-bit hashes. A document is
+kept by the servers owning the first points clockwise from the hash of its id,
+points of servers already chosen are skipped. Adding a server to ``N`` others
+moves about ``1 / (N + 1)`` of the documents to it, the rest stay where they are.
+"""
+import hashlib
+from bisect import bisect
+
+VNODES = 128
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+def server_key(server: dict) -> str:
+    return f"{server['host']}:{server['port']}"
+
+
+class HashRing:
+    def __init__(self, servers: list[dict], vnodes: int = VNODES):
+        self.servers = {server_key(server): server for server in servers}
+        points = sorted((_hash(f"{key}#{i}"), key) for key in self.servers for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._keys = [key for _, key in points]
+
+    def replicas(self, file_id: int, count: int) -> list[dict]:
+        """Servers keeping a document, at most ``count`` of them"""
+        count = min(count, len(self.servers))
+        chosen = []
+        start = bisect(self._hashes, _hash(str(file_id)))
+        for i in range(len(self._keys)):
+            if len(chosen) == count:
+                break
+            key = self._keys[(start + i) % len(self._keys)]
+            if key not in chosen:
+                chosen.append(key)
+        return [self.servers[key] for key in chosen]
+
+    def moves(self, other: "HashRing", file_id: int, count: int) -> tuple[list[dict], list[dict]]:
+        """Servers of ``other`` gaining the document and servers of this ring losing it"""
+        before, after = self.replicas(file_id, count), other.replicas(file_id, count)
+        before_keys, after_keys = set(map(server_key, before)), set(map(server_key, after))
+        return ([server for server in after if server_key(server) not in before_keys],
+                [server for server in before if server_key(server) not in after_keys])
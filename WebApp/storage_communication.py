@@ -1,12 +1,22 @@
 import asyncio
+import itertools
+import json
 import os
+import shutil
+import struct
+import threading
 import time
+import weakref
 from asyncio import IncompleteReadError
 from logging import basicConfig, StreamHandler, DEBUG, warning
 from logging import info, error, debug
 from string import digits, ascii_lowercase
 from typing import TypedDict, Literal
 
+import erasure
+from chunking import chunk_file
+from delta import MAX_LITERAL_SHARE, TooDifferent, make_delta
+
 basicConfig(
     level=DEBUG,
     format='%(asctime)s [%(levelname)s]: %(message)s',
@@ -16,6 +26,15 @@ basicConfig(
 
 BATCH_SIZE = 1024
 
+# Multiplexed protocol: after a "Mux#" command every message is a frame
+# (request id, frame type, payload length) followed by the payload.
+# Closing a request before its response ended sends CLOSE to the storage.
+FRAME_HEADER = struct.Struct("!IBI")
+CALL, DATA, EOF, CLOSE = range(4)
+FRAME_SIZE = 64 * 1024
+# Messages of any size, e.g. chunk manifests, are preceded by their length
+LENGTH = struct.Struct("!I")
+
 debug_storages = [
     {"host": "127.0.0.1", "port": 12345},
 ]
@@ -34,10 +53,15 @@ class Storage(TypedDict):
     port: int
 
 
-def id2scrap(file_id: int) -> str:
+class SearchError(Exception):
+    """A storage refused a search, e.g. for an invalid regular expression or over its time budget"""
+
+
+def id2scrap(file_id: int, segment: int | None = None) -> str:
     """Convert file id to scrap
 
     :param file_id: id of file in database
+    :param segment: index of a segment of a sharded file
     :return: Name of file in storage
     """
     alpha = digits + ascii_lowercase
@@ -46,178 +70,1049 @@ def id2scrap(file_id: int) -> str:
     while file_id > 0:
         string = alpha[file_id % base] + string
         file_id //= base
-    return string + ".txt#"
+    if segment is not None:
+        string += f".{segment}"
+    return string + ".txt"
+
+
+class FrameReader:
+    """Response stream of one request on a multiplexed connection"""
+
+    def __init__(self):
+        self._chunks = asyncio.Queue(maxsize=16)
+        self._buffer = bytearray()
+        self._eof = False
+        # The storage sent the whole response, though the caller may not have read it yet
+        self.finished = False
+        # The response ended with EOF, not cut short by CLOSE or a lost connection
+        self.complete = False
+
+    async def feed(self, data: bytes) -> None:
+        """Pass a response chunk to the caller, empty bytes mean end of response"""
+        if not data:
+            self.finished = True
+        await self._chunks.put(data)
+
+    def abort(self) -> None:
+        """End the response after the connection was lost"""
+        while not self._chunks.empty():
+            self._chunks.get_nowait()
+        self._chunks.put_nowait(b"")
+
+    async def _fill(self) -> None:
+        chunk = await self._chunks.get()
+        if chunk:
+            self._buffer += chunk
+        else:
+            self._eof = True
+
+    async def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            while not self._eof:
+                await self._fill()
+            n = len(self._buffer)
+        elif not self._buffer and not self._eof:
+            await self._fill()
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readuntil(self, separator: bytes = b"\n") -> bytes:
+        while (position := self._buffer.find(separator)) < 0:
+            if self._eof:
+                raise IncompleteReadError(bytes(self._buffer), None)
+            await self._fill()
+        return await self.read(position + len(separator))
+
+    async def readexactly(self, n: int) -> bytes:
+        while len(self._buffer) < n:
+            if self._eof:
+                raise IncompleteReadError(bytes(self._buffer), n)
+            await self._fill()
+        return await self.read(n)
+
+    async def readline(self) -> bytes:
+        """Next line with its newline, the rest of the response at its end"""
+        try:
+            return await self.readuntil(b"\n")
+        except IncompleteReadError as er:
+            return er.partial
+
+
+class FrameWriter:
+    """Request body stream of one request on a multiplexed connection"""
+
+    def __init__(self, connection: "Connection", request_id: int):
+        self._connection = connection
+        self._request_id = request_id
+
+    def write(self, data: bytes) -> None:
+        data = memoryview(data)
+        for i in range(0, len(data), FRAME_SIZE):
+            self._connection.send(self._request_id, DATA, data[i:i + FRAME_SIZE])
+
+    def write_eof(self) -> None:
+        self._connection.send(self._request_id, EOF)
+
+    async def drain(self) -> None:
+        await self._connection.writer.drain()
+
+    def close(self) -> None:
+        self._connection.forget(self._request_id)
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+class Connection:
+    """Long-lived connection to a storage shared by all concurrent requests
+
+    Every request gets its own id, so responses may arrive in any order.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._responses: dict[int, FrameReader] = {}
+        self._listener = asyncio.create_task(self._listen())
+
+    def send(self, request_id: int, kind: int, payload: bytes = b"") -> None:
+        self.writer.writelines((FRAME_HEADER.pack(request_id, kind, len(payload)), payload))
+
+    def forget(self, request_id: int) -> None:
+        """Ignore the rest of the response, a search still running on the storage is stopped"""
+        response = self._responses.pop(request_id, None)
+        if response is not None and not response.finished and not self.closed:
+            self.send(request_id, CLOSE)
+
+    async def request(self, command: str, *args: str) -> tuple[FrameReader, FrameWriter]:
+        """Start a new request
 
+        :param command: storage command, e.g. "Add"
+        :param args: command arguments, may contain any characters
+        :return: response reader and request body writer
+        """
+        request_id = next(self._ids)
+        self._responses[request_id] = FrameReader()
+        self.send(request_id, CALL, json.dumps([command, *args]).encode())
+        await self.writer.drain()
+        return self._responses[request_id], FrameWriter(self, request_id)
 
-async def add_file(storage: Storage, file_id: int, file_name: str, file_folder: str) -> dict[str, str]:
+    async def _listen(self) -> None:
+        try:
+            while True:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                request_id, kind, length = FRAME_HEADER.unpack(header)
+                payload = await self.reader.readexactly(length)
+                response = self._responses.get(request_id)
+                if response is None:
+                    continue
+                if kind == DATA:
+                    await response.feed(payload)
+                elif kind == EOF:
+                    response.complete = True
+                    await response.feed(b"")
+                elif kind == CLOSE:
+                    await response.feed(b"")
+                    self.forget(request_id)
+        except (IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            for response in self._responses.values():
+                response.abort()
+            self._responses.clear()
+
+    async def close(self) -> None:
+        self.closed = True
+        self._listener.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+_connections: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+async def _connect(host: str, port: int) -> Connection:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write("Mux#".encode())
+    return Connection(reader, writer)
+
+
+async def request(storage: Storage, command: str, *args: str) -> tuple[FrameReader, FrameWriter]:
+    """Send a command over the shared connection to the storage
+
+    Connections are opened on first use and kept for the life of the event loop.
+    """
+    pool = _connections.setdefault(asyncio.get_running_loop(), {})
+    key = (storage["host"], int(storage["port"]))
+    if key not in pool or pool[key].done() and pool[key].result().closed:
+        pool[key] = asyncio.ensure_future(_connect(*key))
     try:
-        reader, writer = await asyncio.open_connection(host=storage["host"], port=storage["port"])
-    except ConnectionRefusedError:
+        connection = await asyncio.shield(pool[key])
+    except OSError:
+        pool.pop(key, None)
+        raise
+    return await connection.request(command, *args)
+
+
+async def close_connections() -> None:
+    """Close all storage connections opened by the running event loop"""
+    pool = _connections.pop(asyncio.get_running_loop(), {})
+    for future in pool.values():
+        if future.done() and not future.exception():
+            await future.result().close()
+
+
+_local = threading.local()
+
+
+def run(coroutine):
+    """Run a coroutine on an event loop kept for the life of the calling thread
+
+    Connections opened by one call are reused by the following ones of the same
+    thread. Calls of one thread must not overlap: the web app makes them from
+    worker threads that run one call at a time.
+    """
+    if getattr(_local, "loop", None) is None:
+        _local.loop = asyncio.new_event_loop()
+    return _local.loop.run_until_complete(coroutine)
+
+
+async def add_file(storage: Storage, file_id: int, file_name: str, file_folder: str,
+                   chunks: list[tuple[str, int, int]] = None, segment: int | None = None) -> dict[str, str]:
+    """Upload a file, sending only the chunks the storage does not hold yet
+
+    :param chunks: result of chunk_file for the file, computed if omitted
+    :param segment: store the file as this segment of a sharded file
+    """
+    if chunks is None:
+        chunks = await asyncio.to_thread(chunk_file, os.path.join(file_folder, file_name))
+    try:
+        reader, writer = await request(storage, "AddChunks", id2scrap(file_id, segment))
+    except OSError:
         return {f"{storage['host']}:{storage['port']}": "Fail"}
-    # Send command
-    writer.write("Add#".encode())
-    # Send filename
-    writer.write(id2scrap(file_id).encode())
-    await writer.drain()
-    # Send file data
-    counter = 0
-    total = os.path.getsize(os.path.join(file_folder, file_name)) / BATCH_SIZE
-    with open(os.path.join(file_folder, file_name), 'rb') as file:
-        file_data = file.read(BATCH_SIZE)
-        while file_data:
-            writer.write(file_data)
-            file_data = file.read(BATCH_SIZE)
-            counter += 1
-            debug(f"Progress: {counter / total * 100:.2f}%")
 
-    writer.write_eof()
+    try:
+        # Send manifest, receive indices of the chunks storage needs
+        manifest = json.dumps([[digest, size] for digest, _, size in chunks]).encode()
+        writer.write(LENGTH.pack(len(manifest)) + manifest)
+        size, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+        missing = json.loads(await reader.readexactly(size))
+        info(f"Sending {len(missing)} of {len(chunks)} chunks")
+
+        # Send file data
+        with open(os.path.join(file_folder, file_name), 'rb') as file:
+            for counter, i in enumerate(missing, 1):
+                _, offset, size = chunks[i]
+                file.seek(offset)
+                writer.write(file.read(size))
+                await writer.drain()
+                debug(f"Progress: {counter / len(missing) * 100:.2f}%")
+        writer.write_eof()
+
+        _ = await reader.readuntil("#".encode())
+    except (IncompleteReadError, OSError):
+        # Also a storage that went down in the middle of the upload
+        return {f"{storage['host']}:{storage['port']}": "Fail"}
+    finally:
+        writer.close()
+
+    return {f"{storage['host']}:{storage['port']}": "OK"}
+
+
+async def patch_file(storage: Storage, file_id: int, file_name: str, file_folder: str) -> dict[str, str]:
+    """Upload an edited file, sending only what differs from the stored version
+
+    A file sharing too little with the stored version, or with no stored version
+    at all, is uploaded by chunks instead.
+    """
+    try:
+        reader, writer = await request(storage, "Patch", id2scrap(file_id))
+    except OSError:
+        return {f"{storage['host']}:{storage['port']}": "Fail"}
 
     try:
+        signature = json.loads(await reader.readuntil(b"\n"))
+        with open(os.path.join(file_folder, file_name), 'rb') as file:
+            data = file.read()
+        try:
+            instructions = await asyncio.to_thread(lambda: list(make_delta(data, signature, MAX_LITERAL_SHARE)))
+        except TooDifferent:
+            info(f"{file_name} differs too much from the stored version, uploading it by chunks")
+            writer.close()
+            return await add_file(storage, file_id, file_name, file_folder)
+
+        buffer, sent = bytearray(), 0
+        for instruction in instructions:
+            buffer += instruction
+            if len(buffer) >= FRAME_SIZE:
+                writer.write(bytes(buffer))
+                sent += len(buffer)
+                buffer.clear()
+                await writer.drain()
+        writer.write(bytes(buffer))
+        writer.write_eof()
+        info(f"Sent delta of {sent + len(buffer)} bytes for {len(data)} bytes of {file_name}")
+
         _ = await reader.readuntil("#".encode())
-    except IncompleteReadError:
+    except (IncompleteReadError, OSError):
         return {f"{storage['host']}:{storage['port']}": "Fail"}
+    finally:
+        writer.close()
 
     return {f"{storage['host']}:{storage['port']}": "OK"}
 
 
-async def delete_file(storage: Storage, file_id: int) -> None:
-    reader, writer = await asyncio.open_connection(storage["host"], storage["port"])
-    # Send command
-    writer.write("Delete#".encode())
-    # Send filename
-    writer.write(id2scrap(file_id).encode())
+async def uploaded(storages: list[Storage], tasks: list[asyncio.Task], quorum: int = 0) -> dict[str, str]:
+    """Statuses of uploads to the storages by "host:port"
+
+    :param quorum: return once this many uploads succeeded, the ones still
+        running are cancelled and reported "Pending"; 0 waits for all
+    """
+    pending, succeeded = set(tasks), 0
+    while pending and (not quorum or succeeded < quorum):
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        succeeded += sum("OK" in e.result().values() for e in done)
+    for e in pending:
+        e.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    result = {}
+    for s, e in zip(storages, tasks):
+        result.update({f"{s['host']}:{s['port']}": "Pending"} if e.cancelled() else e.result())
+    return result
+
+
+async def delete_file(storage: Storage, file_id: int, segment: int | None = None) -> None:
+    reader, writer = await request(storage, "Delete", id2scrap(file_id, segment))
+    # Wait until the storage has finished
+    await reader.read()
     writer.close()
     await writer.wait_closed()
 
 
-async def download_file(storage: Storage, file_id: int, file_name: str, file_folder: str) -> bool:
+async def add_many(storage: Storage, files: list[dict], file_folder: str) -> dict[int, str]:
+    """Upload several files with one request
+
+    :param files: dicts with "id" and "name" of the file in ``file_folder``
+    :return: "OK" or "Fail" by file id
+    """
+    try:
+        reader, writer = await request(storage, "AddMany")
+    except ConnectionRefusedError:
+        return {f["id"]: "Fail" for f in files}
+
+    try:
+        for f in files:
+            path = os.path.join(file_folder, f["name"])
+            left = os.path.getsize(path)
+            writer.write(json.dumps({"name": id2scrap(f["id"]), "size": left}).encode() + b"\n")
+            with open(path, 'rb') as file:
+                while left > 0:
+                    file_data = file.read(min(left, FRAME_SIZE))
+                    if not file_data:
+                        raise ValueError(f"{path} was truncated while sending")
+                    writer.write(file_data)
+                    left -= len(file_data)
+                    await writer.drain()
+        writer.write_eof()
+        statuses = json.loads(await reader.read())
+    except (IncompleteReadError, ValueError):
+        return {f["id"]: "Fail" for f in files}
+    finally:
+        writer.close()
+
+    return {f["id"]: status for f, status in zip(files, statuses)}
+
+
+def storage_names(file: dict) -> list[str]:
+    """Names of a file on storages: its segments if it is sharded, its shards if it is erasure coded"""
+    if file.get("segments"):
+        return [id2scrap(file["id"], segment) for segment in range(file["segments"] + (file.get("parity") or 0))]
+    return [id2scrap(file["id"])]
+
+
+async def delete_many(storage: Storage, files: list[dict]) -> dict[int, str]:
+    """Delete several files with one request
+
+    :param files: dicts with "id" and, for sharded files, "segments"
+    :return: "OK", "Missing" or "Fail" by file id; a sharded file is "OK" if
+        any of its segments was deleted
+    """
+    names = [storage_names(f) for f in files]
     try:
-        reader, writer = await asyncio.open_connection(storage["host"], storage["port"])
+        reader, writer = await request(storage, "DeleteMany")
     except ConnectionRefusedError:
+        return {f["id"]: "Fail" for f in files}
+
+    try:
+        writer.write(json.dumps([name for file_names in names for name in file_names]).encode())
+        writer.write_eof()
+        statuses = iter(json.loads(await reader.read()))
+    except ValueError:
+        return {f["id"]: "Fail" for f in files}
+    finally:
+        writer.close()
+
+    result = {}
+    for f, file_names in zip(files, names):
+        file_statuses = [next(statuses) for _ in file_names]
+        result[f["id"]] = "Fail" if "Fail" in file_statuses else "OK" if "OK" in file_statuses else "Missing"
+    return result
+
+
+async def download_file(storage: Storage, file_id: int, file_name: str, file_folder: str,
+                        segment: int | None = None, append: bool = False) -> bool:
+    """Save a file, or a segment of a sharded file, to ``file_folder``
+
+    The data is received into a temporary file first, so a storage that does
+    not hold the file or fails while sending it leaves ``file_name`` as it was.
+
+    :param append: add to the end of the file instead of replacing it
+    :return: whether the storage sent the whole file
+    """
+    try:
+        reader, writer = await request(storage, "Get", id2scrap(file_id, segment))
+    except OSError:
         return False
-    # Send command
-    writer.write("Get#".encode())
-    # Send filename
-    writer.write(id2scrap(file_id).encode())
-    # Receive file data
-    info("READING FILE")
-    with open(os.path.join(file_folder, file_name), 'wb') as file:
-        file_data = await reader.read(BATCH_SIZE)
-        while file_data:
-            file.write(file_data)
+    path = os.path.join(file_folder, file_name)
+    part_path = f"{path}.part"
+    try:
+        # Receive file data
+        info("READING FILE")
+        with open(part_path, 'wb') as file:
             file_data = await reader.read(BATCH_SIZE)
-    info("FILE IS RED")
-    return True
-
-
-async def find_substring(storage: Storage, file_id: int, start: int, stop: int, substring: str) -> [str]:
-    reader, writer = await asyncio.open_connection(storage["host"], storage["port"])
-    # Send command
-    writer.write("Find#".encode())
-    # Send filename
-    writer.write(id2scrap(file_id).encode())
-    # Send start and stop
-    writer.write(f"{start}#{stop}#".encode())
-    # Send substring
-    writer.write(substring.encode())
-    writer.write_eof()
+            while file_data:
+                file.write(file_data)
+                file_data = await reader.read(BATCH_SIZE)
+        if not reader.complete:
+            warning(f"{storage['host']}:{storage['port']} did not send {id2scrap(file_id, segment)}")
+            return False
+        if append:
+            await asyncio.to_thread(_append_file, part_path, path)
+        else:
+            os.replace(part_path, path)
+        info("FILE IS RED")
+        return True
+    finally:
+        writer.close()
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
 
-    found = await reader.readuntil("#".encode())
-    if found.decode() == "Y#":
-        found_lines = ""
-        found_data = await reader.read(BATCH_SIZE)
-        while found_data:
-            found_lines += found_data.decode()
+
+def _append_file(source: str, destination: str) -> None:
+    with open(source, 'rb') as source_file, open(destination, 'ab') as destination_file:
+        shutil.copyfileobj(source_file, destination_file, FRAME_SIZE)
+
+
+async def read_range(storage: Storage, file_id: int, unit: Literal["lines", "bytes"],
+                     first: int, last: int, segment: int | None = None) -> bytes:
+    """Read a part of a file
+
+    :param unit: "lines" for lines first..last (1-based, inclusive),
+        "bytes" for last bytes starting at offset first
+    :param segment: read from this segment of a sharded file, lines are counted within it
+    """
+    reader, writer = await request(storage, "Get", id2scrap(file_id, segment), unit, str(first), str(last))
+    data = await reader.read()
+    writer.close()
+    return data
+
+
+def group_rows(rows: list[int]) -> list[tuple[int, int]]:
+    """Merge line numbers into ranges of consecutive lines"""
+    ranges = []
+    for row in sorted(set(rows)):
+        if ranges and ranges[-1][1] == row - 1:
+            ranges[-1] = (ranges[-1][0], row)
+        else:
+            ranges.append((row, row))
+    return ranges
+
+
+async def read_rows(storages: list[Storage], file_id: int, rows: list[int],
+                    segment: int | None = None) -> dict[int, str]:
+    """Fetch only the given lines of a file, spreading the ranges over storages"""
+    ranges = group_rows(rows)
+    parts = await asyncio.gather(*[
+        read_range(storages[i % len(storages)], file_id, "lines", first, last, segment)
+        for i, (first, last) in enumerate(ranges)
+    ])
+    result = {}
+    for (first, last), data in zip(ranges, parts):
+        for row, line in zip(range(first, last + 1), data.decode(errors="replace").split("\n")):
+            result[row] = line.removesuffix("\r")
+    return result
+
+
+async def find_substring(storage: Storage, file_id: int, start: int, stop: int, substring: str,
+                         regex: bool = False, ignore_case: bool = False, whole_word: bool = False,
+                         snippet: int = 0, limit: int = 0, count_only: bool = False,
+                         segment: int | None = None) -> list[str] | dict[int, str] | int:
+    """Numbers of lines in ``start``..``stop`` containing ``substring``
+
+    Raises SearchError with the storage's message if it cannot search.
+
+    :param regex: treat ``substring`` as a regular expression
+    :param ignore_case: match regardless of letter case
+    :param whole_word: only match ``substring`` not surrounded by letters, digits or "_"
+    :param snippet: if set, return the text of every found line by its number,
+        cut to this many characters around the match
+    :param limit: if set, the storage stops after this many lines
+    :param count_only: return only the number of lines
+    :param segment: search this segment of a sharded file, lines are counted within it
+    """
+    options = {key: True for key, value in
+               (("regex", regex), ("ignore_case", ignore_case), ("whole_word", whole_word),
+                ("count_only", count_only)) if value}
+    if snippet:
+        options["snippet"] = snippet
+    if limit:
+        options["limit"] = limit
+    reader, writer = await request(storage, "Find", id2scrap(file_id, segment), str(start), str(stop),
+                                   *([json.dumps(options)] if options else []))
+    # Closing the request also stops the search if the caller gives up on it
+    try:
+        # Send substring
+        writer.write(substring.encode())
+        writer.write_eof()
+
+        found = await reader.readuntil("#".encode())
+        if found.decode() == "C#":
+            return int(await reader.read())
+        elif found.decode() == "Y#" and snippet:
+            found_lines = {}
+            while line := await reader.readline():
+                number, text = json.loads(line)
+                found_lines[number] = text
+            return found_lines
+        elif found.decode() == "Y#":
+            found_lines = ""
             found_data = await reader.read(BATCH_SIZE)
+            while found_data:
+                found_lines += found_data.decode()
+                found_data = await reader.read(BATCH_SIZE)
+            return found_lines.split(";")
+        elif found.decode() == "N#":
+            return 0 if count_only else []
+        elif found.decode() == "E#":
+            message = (await reader.read()).decode()
+            error(f"Storage could not search: {message}")
+            raise SearchError(message)
+        else:
+            error("Wrong response from storage")
+            return 0 if count_only else []
+    finally:
         writer.close()
         await writer.wait_closed()
-        return found_lines.split(";")
-    elif found.decode() == "N#":
-        writer.close()
-        await writer.wait_closed()
-        return []
-    else:
-        error("Wrong response from storage")
-        writer.close()
-        await writer.wait_closed()
-        return []
+
+
+async def first_found(tasks: list[asyncio.Task], limit: int, in_order: bool = True) -> None:
+    """Wait for searches of consecutive splits until ``limit`` lines are found, cancel the rest
+
+    :param in_order: count only splits whose preceding splits are done too, so
+        the lines found are the first ones of the document
+    """
+    pending = set(tasks)
+    try:
+        while pending:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            done = list(itertools.takewhile(asyncio.Task.done, tasks)) if in_order else \
+                [task for task in tasks if task.done()]
+            if sum(len(task.result()) for task in done) >= limit:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+async def find_splits(parts: list[tuple[Storage, int, int, int | None, int]], file_id: int, substring: str,
+                      regex: bool = False, ignore_case: bool = False, whole_word: bool = False,
+                      snippet: int = 0, limit: int = 0, count_only: bool = False,
+                      exists: bool = False) -> list[int] | dict[int, str] | int | bool:
+    """Search the splits of a file at once and merge what they found
+
+    :param parts: storage, first and last line, segment and the number of lines
+        of the file before the segment for every split
+    :param exists: only tell whether any line matches
+    :return: as of find_substring, with line numbers counted from the start of the file
+    """
+    if exists:
+        limit = 1
+    task = [asyncio.create_task(shifted(
+        find_substring(storage_object, file_id, start, stop, substring, regex, ignore_case, whole_word,
+                       snippet, limit, count_only, segment),
+        shift)) for storage_object, start, stop, segment, shift in parts]
+
+    try:
+        if limit and not count_only:
+            # Splits past the ones holding the first lines are not needed,
+            # any line will do to tell that one exists
+            await first_found(task, limit, in_order=not exists)
+        else:
+            await asyncio.wait(task)
+    finally:
+        # Collect every split, so the errors of the ones not looked at are retrieved too
+        for e in task:
+            e.cancel()
+        outcomes = await asyncio.gather(*task, return_exceptions=True)
+    response = [e for e in outcomes if not isinstance(e, asyncio.CancelledError)]
+    for e in response:
+        if isinstance(e, Exception):
+            raise e
+    if count_only:
+        count = sum(response)
+        return min(count, limit) if limit else count
+    if exists:
+        return any(response)
+    if snippet:
+        texts = {}
+        for e in response:
+            texts.update(e or {})
+        return dict(sorted(texts.items())[:limit]) if limit else texts
+    result = []
+    for e in response:
+        result.extend(list(map(int, e)))
+    return sorted(result)[:limit] if limit else result
+
+
+async def find_many(storage: Storage, file_id: int, start: int, stop: int,
+                    substrings: list[str]) -> list[list[int]]:
+    reader, writer = await request(storage, "FindMany", id2scrap(file_id), str(start), str(stop))
+    # Send substrings
+    writer.write(json.dumps(substrings).encode())
+    writer.write_eof()
+
+    hits = json.loads(await reader.read())
+    writer.close()
+    return hits
+
+
+def split_lines(lines: int, storages: list[Storage]) -> list[tuple[Storage, int, int]]:
+    """Split lines of a file between storages
+
+    :param lines: number of lines in file
+    :param storages: storages holding the file
+    :return: storage with the first and the last line it has to process
+    """
+    amount_of_lines = lines // min(lines, len(storages))
+    parts = []
+    line = 1
+    for i, storage_object in enumerate(storages):
+        if line > lines:
+            break
+        if i == len(storages) - 1:
+            amount_of_lines = lines - line
+
+        info(f"Split by {line}:{line + amount_of_lines}")
+        parts.append((storage_object, line, line + amount_of_lines))
+        line += amount_of_lines + 1
+    return parts
+
+
+def split_segments(path: str, count: int) -> list[tuple[int, int, int, int]]:
+    """Cut a file into at most ``count`` segments of whole lines and about the same size
+
+    :return: first and last line (1-based, inclusive), offset and size in bytes of every segment
+    """
+    size = os.path.getsize(path)
+    segments = []
+    with open(path, 'rb') as file:
+        bounds = [0]
+        for k in range(1, count):
+            # Move to the start of the line following the cut
+            file.seek(max(size * k // count - 1, bounds[-1]))
+            file.readline()
+            bounds.append(min(file.tell(), size))
+        bounds.append(size)
+
+        line = 1
+        for start, end in zip(bounds, bounds[1:]):
+            if start >= end:
+                continue
+            file.seek(start)
+            lines, left, data = 0, end - start, b""
+            while left > 0 and (data := file.read(min(left, FRAME_SIZE))):
+                lines += data.count(b"\n")
+                left -= len(data)
+            if not data.endswith(b"\n"):
+                lines += 1
+            segments.append((line, line + lines - 1, start, end - start))
+            line += lines
+    return segments
+
+
+def segment_holders(placement: list[dict]) -> list[tuple[dict, list[Storage]]]:
+    """Segments of a sharded file in order, each with the storages holding it
+
+    :param placement: records with "host", "port", "segment", "first_line" and "last_line";
+        records without lines, of parity shards of an erasure coded file, are left out
+    """
+    segments = {}
+    for record in placement:
+        if record["first_line"] is None:
+            continue
+        segments.setdefault(record["segment"], (record, []))[1].append(
+            {"host": record["host"], "port": int(record["port"])})
+    return [segments[segment] for segment in sorted(segments)]
+
+
+async def add_segments(storages: list[Storage], file_id: int, file_name: str, file_folder: str,
+                       copies: int, count: int = 0) -> list[dict]:
+    """Upload a file as line-aligned segments, each to ``copies`` of the storages
+
+    Segment ``i`` goes to storages ``i`` to ``i + copies - 1``, wrapping around,
+    so every storage keeps about ``copies / len(storages)`` of the file.
+
+    :param count: number of segments, one per storage if 0
+    :return: placement records with "host", "port", "segment", "first_line",
+        "last_line" and the "status" of the upload
+    """
+    path = os.path.join(file_folder, file_name)
+    segments = split_segments(path, count or len(storages))
+    copies = min(copies, len(storages))
+    placement, uploads = [], []
+    try:
+        with open(path, 'rb') as file:
+            for segment, (first_line, last_line, offset, size) in enumerate(segments):
+                segment_name = f"{file_name}.{segment}"
+                file.seek(offset)
+                with open(os.path.join(file_folder, segment_name), 'wb') as segment_file:
+                    while size > 0 and (data := file.read(min(size, FRAME_SIZE))):
+                        segment_file.write(data)
+                        size -= len(data)
+                chunks = await asyncio.to_thread(chunk_file, os.path.join(file_folder, segment_name))
+                for k in range(copies):
+                    storage = storages[(segment + k) % len(storages)]
+                    placement.append({"host": storage["host"], "port": storage["port"], "segment": segment,
+                                      "first_line": first_line, "last_line": last_line})
+                    uploads.append(add_file(storage, file_id, segment_name, file_folder, chunks, segment))
+        statuses = await asyncio.gather(*uploads)
+    finally:
+        _remove_parts(file_folder, file_name, len(segments))
+    for record, status in zip(placement, statuses):
+        record["status"] = next(iter(status.values()))
+    return placement
+
+
+def _remove_parts(file_folder: str, file_name: str, count: int) -> None:
+    for index in range(count):
+        try:
+            os.remove(os.path.join(file_folder, f"{file_name}.{index}"))
+        except FileNotFoundError:
+            pass
+
+
+async def add_coded(storages: list[Storage], file_id: int, file_name: str, file_folder: str,
+                    count: int, parity: int) -> list[dict]:
+    """Upload a file erasure coded into ``count`` data shards and ``parity`` parity shards
+
+    Data shards are the line-aligned segments of the file, so storages search
+    them as segments of a sharded file. Each gets a line end and then zero bytes
+    up to the size of the largest one. Shard ``i`` goes to storage ``i``,
+    wrapping around; any ``count`` shards rebuild the file.
+
+    :return: placement records as of add_segments, "first_line" and "last_line"
+        are None for parity shards and for data shards left empty
+    """
+    path = os.path.join(file_folder, file_name)
+    segments = split_segments(path, count)
+    data = []
+    with open(path, 'rb') as file:
+        for _, _, offset, size in segments:
+            file.seek(offset)
+            data.append(file.read(size) + b"\n")
+    data += [b"\n"] * (count - len(data))
+    width = max(map(len, data))
+    data = [shard.ljust(width, b"\0") for shard in data]
+    shards = data + await asyncio.to_thread(erasure.encode, data, parity)
+
+    placement, uploads = [], []
+    try:
+        for index, shard in enumerate(shards):
+            shard_name = f"{file_name}.{index}"
+            with open(os.path.join(file_folder, shard_name), 'wb') as shard_file:
+                shard_file.write(shard)
+            storage = storages[index % len(storages)]
+            first_line, last_line = segments[index][:2] if index < len(segments) else (None, None)
+            placement.append({"host": storage["host"], "port": storage["port"], "segment": index,
+                              "first_line": first_line, "last_line": last_line})
+            uploads.append(add_file(storage, file_id, shard_name, file_folder, segment=index))
+        statuses = await asyncio.gather(*uploads)
+    finally:
+        _remove_parts(file_folder, file_name, len(shards))
+    for record, status in zip(placement, statuses):
+        record["status"] = next(iter(status.values()))
+    return placement
+
+
+async def fetch_shard(holders: list[Storage], file_id: int, file_name: str, file_folder: str,
+                      index: int) -> bytes | None:
+    """Shard ``index`` from the first of its holders that has it, None if none has"""
+    shard_name = f"{file_name}.{index}"
+    try:
+        for storage in holders:
+            if await download_file(storage, file_id, shard_name, file_folder, index):
+                with open(os.path.join(file_folder, shard_name), 'rb') as file:
+                    return file.read()
+        return None
+    finally:
+        try:
+            os.remove(os.path.join(file_folder, shard_name))
+        except FileNotFoundError:
+            pass
+
+
+async def get_coded(placement: list[dict], file_id: int, file_name: str, file_folder: str,
+                    count: int, parity: int) -> None:
+    """Rebuild an erasure coded file from its shards
+
+    The data shards are fetched first, parity shards only stand in for the
+    data shards that could not be fetched.
+    """
+    holders = {}
+    for record in placement:
+        holders.setdefault(record["segment"], []).append({"host": record["host"], "port": int(record["port"])})
+
+    shards = {}
+    wanted = list(range(count))
+    spare = iter(range(count, count + parity))
+    while wanted:
+        fetched = await asyncio.gather(*(fetch_shard(holders.get(index, []), file_id, file_name, file_folder, index)
+                                         for index in wanted))
+        shards.update({index: shard for index, shard in zip(wanted, fetched) if shard is not None})
+        wanted = list(itertools.islice(spare, count - len(shards)))
+        if len(shards) < count and not wanted:
+            raise FileNotFoundError(f"{len(shards)} of the {count} shards needed are available")
+
+    data = await asyncio.to_thread(erasure.decode, shards, count, parity)
+    with open(os.path.join(file_folder, file_name), 'wb') as file:
+        for shard in data:
+            # Drop the padding and the line end added to the segment
+            file.write(shard.rstrip(b"\0")[:-1])
+
+
+async def shifted(search, shift: int):
+    """Result of a search in a segment, with line numbers counted from the start of the file"""
+    found = await search
+    if isinstance(found, dict):
+        return {number + shift: text for number, text in found.items()}
+    if isinstance(found, list):
+        return [int(number) + shift for number in found]
+    return found
+
+
+async def add_sharded(storages: list[Storage], file_id: int, file_name: str, file_folder: str,
+                      segments: int, parity: int = 0, copies: int = 1) -> list[dict]:
+    """Upload a file as segments, or erasure coded shards if ``parity`` is set
+
+    :return: placement records as of add_segments
+    """
+    if parity:
+        return await add_coded(storages, file_id, file_name, file_folder, segments, parity)
+    return await add_segments(storages, file_id, file_name, file_folder, copies, segments)
+
+
+async def delete_sharded(storages: list[Storage], file_id: int, segments: int, parity: int = 0) -> None:
+    """Delete the segments, or the data and parity shards, of a file from every storage"""
+    await asyncio.gather(*(delete_many(s, [{"id": file_id, "segments": segments, "parity": parity}])
+                           for s in storages))
+
+
+async def get_sharded(placement: list[dict], file_id: int, file_name: str, file_folder: str,
+                      segments: int, parity: int = 0) -> None:
+    """Join the segments of a sharded file, or rebuild an erasure coded one, in ``file_folder``
+
+    Raises FileNotFoundError if no storage holds one of the segments.
+    """
+    if parity:
+        await get_coded(placement, file_id, file_name, file_folder, segments, parity)
+        return
+    open(os.path.join(file_folder, file_name), 'wb').close()
+    for record, holders in segment_holders(placement):
+        for storage in holders:
+            if await download_file(storage, file_id, file_name, file_folder, record["segment"], append=True):
+                break
+        else:
+            raise FileNotFoundError(f"No storage holds segment {record['segment']}")
+
+
+async def read_sharded(placement: list[dict], file_id: int, rows: list[int]) -> dict[int, str]:
+    """Fetch only the given lines of a sharded file from the segments holding them"""
+    parts, shifts = [], []
+    for record, holders in segment_holders(placement):
+        shift = record["first_line"] - 1
+        local = [row - shift for row in rows if record["first_line"] <= row <= record["last_line"]]
+        if local:
+            parts.append(read_rows(holders, file_id, local, record["segment"]))
+            shifts.append(shift)
+    result = {}
+    for shift, part in zip(shifts, await asyncio.gather(*parts)):
+        result.update({row + shift: text for row, text in part.items()})
+    return result
+
+
+async def find_sharded(placement: list[dict], file_id: int, substring: str, *,
+                       regex: bool = False, ignore_case: bool = False, whole_word: bool = False,
+                       snippet: int = 0, limit: int = 0, count_only: bool = False,
+                       exists: bool = False) -> list[int] | dict[int, str] | int | bool:
+    """Search a sharded file, every segment split between the storages holding it
+
+    Options are those of find_splits.
+    """
+    parts = [(storage_object, start, stop, record["segment"], record["first_line"] - 1)
+             for record, holders in segment_holders(placement)
+             for storage_object, start, stop in
+             split_lines(record["last_line"] - record["first_line"] + 1, holders)]
+    return await find_splits(parts, file_id, substring, regex, ignore_case, whole_word,
+                             snippet, limit, count_only, exists)
 
 
 async def get_info(storage: Storage) -> list[int]:
-    reader, writer = await asyncio.open_connection(storage["host"], storage["port"])
-    writer.write("Info#".encode())
+    reader, writer = await request(storage, "Info")
     data = await reader.readuntil("#".encode())
+    writer.close()
     data = data.decode()[:-1]
     nums = list(map(int, data.split('/')))
     return nums
 
 
+async def get_stats(storage: Storage) -> dict:
+    """Load counters of a storage: per command counts, bytes, latency percentiles, loop lag"""
+    reader, writer = await request(storage, "Stats")
+    data = await reader.read()
+    writer.close()
+    return json.loads(data)
+
+
 async def end_server(storage: Storage) -> None:
-    reader, writer = await asyncio.open_connection(storage["host"], storage["port"])
-    # Send command
-    writer.write("End#".encode())
+    reader, writer = await request(storage, "End")
     writer.close()
     await writer.wait_closed()
 
 
 async def add_server(storage: Storage, new_storage: Storage) -> None:
-    reader, writer = await asyncio.open_connection(storage["host"], storage["port"])
-    # Send command
-    writer.write("AddServer#".encode())
-    # Send new storage host
-    writer.write(new_storage["host"].encode() + "#".encode())
-    # Send new storage port
-    writer.write(str(new_storage["port"]).encode() + "#".encode())
+    reader, writer = await request(storage, "AddServer", new_storage["host"], str(new_storage["port"]))
     writer.close()
     await writer.wait_closed()
 
 
+async def sync_server(storage: Storage, new_storage: Storage) -> dict:
+    """Send ``new_storage`` the documents of ``storage`` it lacks or holds in another version
+
+    :return: report with the documents "sent", "failed" and "extra" ones only ``new_storage`` has
+    """
+    reader, writer = await request(storage, "Sync", new_storage["host"], str(new_storage["port"]))
+    data = await reader.read()
+    writer.close()
+    return json.loads(data)
+
+
+async def copy_many(storage: Storage, new_storage: Storage, file_ids: list[int]) -> dict[int, str]:
+    """Make ``storage`` send documents straight to ``new_storage``
+
+    :return: "OK" or "Fail" by file id
+    """
+    try:
+        reader, writer = await request(storage, "CopyMany", new_storage["host"], str(new_storage["port"]))
+    except ConnectionRefusedError:
+        return {file_id: "Fail" for file_id in file_ids}
+
+    try:
+        writer.write(json.dumps([id2scrap(file_id) for file_id in file_ids]).encode())
+        writer.write_eof()
+        sent = set(json.loads(await reader.read())["sent"])
+    except ValueError:
+        return {file_id: "Fail" for file_id in file_ids}
+    finally:
+        writer.close()
+
+    return {file_id: "OK" if id2scrap(file_id) in sent else "Fail" for file_id in file_ids}
+
+
+async def move_files(files: list[dict]) -> list[str]:
+    """Copy documents between storages, one request for every pair of storages
+
+    :param files: dicts with the "id" of the document, the "source" storage
+        holding it and the "target" storage to copy it to
+    :return: "OK" or "Fail" for every item of ``files``
+    """
+    def pair(f: dict) -> tuple:
+        return f["source"]["host"], int(f["source"]["port"]), f["target"]["host"], int(f["target"]["port"])
+
+    pairs = {}
+    for f in files:
+        pairs.setdefault(pair(f), (f["source"], f["target"], []))[2].append(f["id"])
+    statuses = await asyncio.gather(*(copy_many(source, target, file_ids) for source, target, file_ids in pairs.values()))
+    result = dict(zip(pairs, statuses))
+    return [result[pair(f)][f["id"]] for f in files]
+
+
 async def ping_server(storage: Storage) -> dict[str, int]:
     start_time = time.time()
 
-    reader, writer = await asyncio.open_connection(storage["host"], storage["port"])
-    writer.write("Ping#".encode())
+    reader, writer = await request(storage, "Ping")
     await reader.readuntil("#".encode())
     writer.close()
-    await writer.wait_closed()
 
     end_time = time.time()
     response_time = end_time - start_time
     return {f"{storage['host']}:{storage['port']}": round(response_time * 1000)}
 
 
-async def manage(mode: Literal["add", "delete", "get", "find", "copy", "end", "ping", "remove"],
+async def manage(mode: Literal["add", "add_many", "patch", "delete", "get", "read", "find", "find_many", "copy", "move", "sync", "end", "info", "stats", "ping", "remove"],
                  file_id: int = -1,
                  filename: str = "",
                  storages: list[Storage] = None,
                  *,
                  substring: str = "",
+                 substrings: list[str] = None,
                  lines: int = 0,
                  file_folder: str = "",
                  destination_folder: str = "",
                  storage: Storage = None,
                  files: list[dict] = None,
-                 ) -> list[int] | dict[str, int] | None:
+                 rows: list[int] = None,
+                 byte_range: tuple[int, int] = None,
+                 regex: bool = False,
+                 ignore_case: bool = False,
+                 whole_word: bool = False,
+                 snippet: int = 0,
+                 limit: int = 0,
+                 count_only: bool = False,
+                 exists: bool = False,
+                 quorum: int = 0,
+                 ) -> list[str] | list[int] | int | bool | dict[str, int] | dict[str, list[int]] | dict[int, str] | dict[str, dict[int, str]] | dict | bytes | None:
     if storage is None:
         storage = {}
     if storages is None:
         storages = []
     if files is None:
         files = []
+    if substrings is None:
+        substrings = []
 
     try:
         match mode:
             case "add":
-                tasks = [asyncio.create_task(add_file(s, file_id, filename, file_folder))
+                chunks = await asyncio.to_thread(chunk_file, os.path.join(file_folder, filename))
+                tasks = [asyncio.create_task(add_file(s, file_id, filename, file_folder, chunks))
                          for s in storages]
-                response, _ = await asyncio.wait(tasks)
-                result = {}
-
-                for e in response:
-                    result.update(e.result())
-
-
-                return result
+                return await uploaded(storages, tasks, quorum)
+            case "patch":
+                tasks = [asyncio.create_task(patch_file(s, file_id, filename, file_folder))
+                         for s in storages]
+                return await uploaded(storages, tasks, quorum)
             case "delete":
                 tasks = [asyncio.create_task(delete_file(s, file_id))
                          for s in storages]
@@ -229,35 +1124,43 @@ async def manage(mode: Literal["add", "delete", "get", "find", "copy", "end", "p
                     if downloaded:
                         return
                 raise FileNotFoundError("All File Versions on Storages are old")
+            case "read":
+                if byte_range is not None:
+                    return await read_range(storages[0], file_id, "bytes", *byte_range)
+                return await read_rows(storages, file_id, rows or [])
             case "find":
                 if len(storages) == 0:
                     return
-                amount_of_lines = lines // min(lines, len(storages))
-                task = []
-                line = 1
-                for i, storage_object in enumerate(storages):
-                    if line > lines:
-                        break
-                    if i == len(storages) - 1:
-                        amount_of_lines = lines - line
-
-                    info(f"Split by {line}:{line + amount_of_lines}")
-                    task.append(asyncio.create_task(
-                        find_substring(storage_object, file_id, line, line + amount_of_lines, substring)
-                    ))
-                    line += amount_of_lines + 1
+                parts = [(storage_object, start, stop, None, 0)
+                         for storage_object, start, stop in split_lines(lines, storages)]
+                return await find_splits(parts, file_id, substring, regex, ignore_case, whole_word,
+                                         snippet, limit, count_only, exists)
+            case "find_many":
+                if len(storages) == 0:
+                    return
+                task = [asyncio.create_task(find_many(storage_object, file_id, start, stop, substrings))
+                        for storage_object, start, stop in split_lines(lines, storages)]
 
                 response, _ = await asyncio.wait(task)
-                result = []
+                result = {substring: [] for substring in substrings}
                 for e in response:
-                    result.extend(list(map(int, e.result())))
-                return result
+                    for substring, hits in zip(substrings, e.result()):
+                        result[substring].extend(hits)
+                return {substring: sorted(hits) for substring, hits in result.items()}
             case "copy":
                 if len(storages) == 0:
                     return
                 await add_server(storages[0], storage)
+            case "move":
+                return await move_files(files)
             case "end":
                 await end_server(storage)
+            case "sync":
+                if len(storages) == 0:
+                    return
+                return await sync_server(storages[0], storage)
+            case "stats":
+                return await get_stats(storage)
             case "info":
                 return await get_info(storage)
             case "ping":
@@ -270,10 +1173,12 @@ async def manage(mode: Literal["add", "delete", "get", "find", "copy", "end", "p
                     for k, v in e.result().items():
                         result[k] = v
                 return result
+            case "add_many":
+                statuses = await asyncio.gather(*(add_many(s, files, file_folder) for s in storages))
+                return {f"{s['host']}:{s['port']}": status for s, status in zip(storages, statuses)}
             case "remove":
-                tasks = [asyncio.create_task(delete_file(s, f["id"]))
-                         for s in storages for f in files]
-                await asyncio.wait(tasks)
+                statuses = await asyncio.gather(*(delete_many(s, files) for s in storages))
+                return {f"{s['host']}:{s['port']}": status for s, status in zip(storages, statuses)}
             case _:
                 warning("Unknown mode")
     except ConnectionRefusedError:
@@ -0,0 +1,75 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage_communication import CALL, CLOSE, DATA, EOF, FRAME_HEADER, LENGTH  # noqa: E402
+
+
+class FakeStorage:
+    """Storage speaking the multiplexed protocol that serves "Get" from ``documents``
+
+    A document it holds is sent followed by EOF, anything else is answered with
+    CLOSE, as the storage does when a command fails. Every response ends with
+    CLOSE, like on the storage. ``cut`` documents are cut off halfway by a
+    dropped connection. "AddChunks" asks for every chunk of the manifest and
+    stores nothing.
+    """
+
+    def __init__(self, documents: dict[str, bytes] = None, cut: set[str] = ()):
+        self.documents = documents or {}
+        self.cut = set(cut)
+        self.requests = []
+        self._uploads = set()
+        self.server = None
+
+    @property
+    def storage(self) -> dict:
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return {"host": host, "port": port}
+
+    def send(self, writer: asyncio.StreamWriter, request_id: int, kind: int, payload: bytes = b"") -> None:
+        writer.write(FRAME_HEADER.pack(request_id, kind, len(payload)) + payload)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        assert await reader.readexactly(4) == b"Mux#"
+        try:
+            while True:
+                request_id, kind, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                payload = await reader.readexactly(length)
+                if kind == DATA and request_id in self._uploads:
+                    self._uploads.discard(request_id)
+                    manifest = json.loads(payload[LENGTH.size:])
+                    missing = json.dumps(list(range(len(manifest)))).encode()
+                    self.send(writer, request_id, DATA, LENGTH.pack(len(missing)) + missing)
+                    await writer.drain()
+                if kind != CALL:
+                    continue
+                command, *args = json.loads(payload)
+                self.requests.append((command, *args))
+                if command == "AddChunks":
+                    self._uploads.add(request_id)
+                    continue
+                data = self.documents.get(args[0]) if command == "Get" else None
+                if args[0] in self.cut:
+                    self.send(writer, request_id, DATA, data[:len(data) // 2])
+                    await writer.drain()
+                    break
+                if data is not None:
+                    self.send(writer, request_id, DATA, data)
+                    self.send(writer, request_id, EOF)
+                self.send(writer, request_id, CLOSE)
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+    async def __aenter__(self) -> "FakeStorage":
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.server.close()
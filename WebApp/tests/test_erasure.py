@@ -0,0 +1,52 @@
+import asyncio
+import itertools
+import random
+
+import pytest
+
+import erasure
+from conftest import FakeStorage
+from storage_communication import close_connections, get_sharded, id2scrap
+
+
+def shards(count: int, parity: int, size: int) -> tuple[list[bytes], list[bytes]]:
+    rng = random.Random(count * 100 + parity)
+    data = [rng.randbytes(size) for _ in range(count)]
+    return data, data + erasure.encode(data, parity)
+
+
+@pytest.mark.parametrize("count, parity", [(1, 1), (2, 1), (3, 2), (4, 3)])
+def test_decode_from_any_shards(count, parity):
+    data, coded = shards(count, parity, 1000)
+    for present in itertools.combinations(range(count + parity), count):
+        assert erasure.decode({index: coded[index] for index in present}, count, parity) == data
+
+
+def test_decode_across_blocks(monkeypatch):
+    monkeypatch.setattr(erasure, "BLOCK_SIZE", 64)
+    data, coded = shards(3, 2, 1000)
+    assert erasure.decode({1: coded[1], 3: coded[3], 4: coded[4]}, 3, 2) == data
+
+
+def test_decode_needs_count_shards():
+    _, coded = shards(3, 2, 10)
+    with pytest.raises(ValueError):
+        erasure.decode({0: coded[0], 4: coded[4]}, 3, 2)
+
+
+def test_coded_file_rebuilt_without_data_shard(tmp_path):
+    segments = [b"a\nb\n", b"c\n"]
+    # Shards as add_coded makes them: a segment, a line end, padding
+    data = [(segment + b"\n").ljust(5, b"\0") for segment in segments]
+    coded = data + erasure.encode(data, 2)
+
+    async def main():
+        async with FakeStorage({id2scrap(1, 1): coded[1], id2scrap(1, 3): coded[3]}) as first, \
+                FakeStorage({id2scrap(1, 2): coded[2]}) as second:
+            placement = [{**fake.storage, "segment": index, "first_line": None, "last_line": None}
+                         for index, fake in enumerate([first, first, second, first])]
+            await get_sharded(placement, 1, "doc.txt", str(tmp_path), 2, 2)
+            await close_connections()
+
+    asyncio.run(main())
+    assert (tmp_path / "doc.txt").read_bytes() == b"".join(segments)
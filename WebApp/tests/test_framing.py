@@ -0,0 +1,74 @@
+import asyncio
+
+from conftest import FakeStorage
+from storage_communication import close_connections, download_file, id2scrap, request
+
+
+async def fetch(fake: FakeStorage, name: str) -> tuple[bytes, bool]:
+    reader, writer = await request(fake.storage, "Get", name)
+    data = await reader.read()
+    writer.close()
+    return data, reader.complete
+
+
+def test_eof_completes_response():
+    async def main():
+        async with FakeStorage({"a.txt": b"text\n"}) as fake:
+            assert await fetch(fake, "a.txt") == (b"text\n", True)
+            await close_connections()
+
+    asyncio.run(main())
+
+
+def test_close_ends_response_early():
+    async def main():
+        async with FakeStorage() as fake:
+            assert await fetch(fake, "a.txt") == (b"", False)
+            await close_connections()
+
+    asyncio.run(main())
+
+
+def test_lost_connection_ends_response_early():
+    async def main():
+        async with FakeStorage({"a.txt": b"0123456789"}, cut={"a.txt"}) as fake:
+            assert await fetch(fake, "a.txt") == (b"01234", False)
+            await close_connections()
+
+    asyncio.run(main())
+
+
+def test_responses_share_connection():
+    async def main():
+        async with FakeStorage({"a.txt": b"a", "b.txt": b"b"}) as fake:
+            results = await asyncio.gather(*(fetch(fake, name) for name in ["a.txt", "b.txt", "c.txt"] * 3))
+            assert results == [(b"a", True), (b"b", True), (b"", False)] * 3
+            await close_connections()
+
+    asyncio.run(main())
+
+
+def test_download_keeps_file_when_not_sent(tmp_path):
+    (tmp_path / "doc.txt").write_bytes(b"old\n")
+
+    async def main():
+        async with FakeStorage({id2scrap(1, 0): b"0123456789"}, cut={id2scrap(1, 0)}) as fake:
+            assert not await download_file(fake.storage, 1, "doc.txt", str(tmp_path))
+            assert not await download_file(fake.storage, 1, "doc.txt", str(tmp_path), 0, append=True)
+            await close_connections()
+
+    asyncio.run(main())
+    assert (tmp_path / "doc.txt").read_bytes() == b"old\n"
+    assert [path.name for path in tmp_path.iterdir()] == ["doc.txt"]
+
+
+def test_download_appends_whole_file(tmp_path):
+    (tmp_path / "doc.txt").write_bytes(b"old\n")
+
+    async def main():
+        async with FakeStorage({id2scrap(1, 1): b"new\n"}) as fake:
+            assert await download_file(fake.storage, 1, "doc.txt", str(tmp_path), 1, append=True)
+            await close_connections()
+
+    asyncio.run(main())
+    assert (tmp_path / "doc.txt").read_bytes() == b"old\nnew\n"
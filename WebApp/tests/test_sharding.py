@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeStorage
+from storage_communication import close_connections, get_sharded, id2scrap, split_lines, split_segments
+
+TEXT = "".join(f"line {i}\n" for i in range(1, 1001)).encode()
+
+
+def cut(path, count: int) -> tuple[list[tuple[int, int, int, int]], list[bytes]]:
+    segments = split_segments(str(path), count)
+    return segments, [TEXT[offset:offset + size] for _, _, offset, size in segments]
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7])
+def test_segments_are_whole_lines(tmp_path, count):
+    (tmp_path / "doc.txt").write_bytes(TEXT)
+    segments, parts = cut(tmp_path / "doc.txt", count)
+    assert len(segments) == count
+    assert b"".join(parts) == TEXT
+    line = 1
+    for (first_line, last_line, _, _), part in zip(segments, parts):
+        assert first_line == line
+        assert part.startswith(f"line {first_line}\n".encode())
+        assert part.endswith(f"line {last_line}\n".encode())
+        line = last_line + 1
+    assert line == 1001
+
+
+def test_segments_of_file_without_last_line_end(tmp_path):
+    (tmp_path / "doc.txt").write_bytes(b"a\nb\nc")
+    assert [segment[:2] for segment in split_segments(str(tmp_path / "doc.txt"), 2)] == [(1, 1), (2, 3)]
+
+
+@pytest.mark.parametrize("lines, count", [(10, 1), (10, 3), (1000, 4), (2, 5)])
+def test_splits_cover_every_line_once(lines, count):
+    storages = [{"host": "localhost", "port": port} for port in range(count)]
+    covered = [line for _, start, stop in split_lines(lines, storages) for line in range(start, stop + 1)]
+    assert covered == list(range(1, lines + 1))
+
+
+def placement(segments, holders: list[list[FakeStorage]]) -> list[dict]:
+    return [{**fake.storage, "segment": segment, "first_line": first_line, "last_line": last_line}
+            for segment, ((first_line, last_line, _, _), fakes) in enumerate(zip(segments, holders))
+            for fake in fakes]
+
+
+def test_sharded_file_joined_from_any_holder(tmp_path):
+    (tmp_path / "doc.txt").write_bytes(TEXT)
+    segments, parts = cut(tmp_path / "doc.txt", 3)
+    out = tmp_path / "out"
+    out.mkdir()
+
+    async def main():
+        # The first holder of segment 0 lost it, the second one of segment 1 drops the connection
+        async with FakeStorage({id2scrap(1, 1): parts[1], id2scrap(1, 2): parts[2]}) as first, \
+                FakeStorage({id2scrap(1, 0): parts[0], id2scrap(1, 1): parts[1]}, cut={id2scrap(1, 1)}) as second:
+            await get_sharded(placement(segments, [[first, second], [second, first], [first]]),
+                              1, "doc.txt", str(out), 3)
+            assert ("Get", id2scrap(1, 0)) in first.requests
+            await close_connections()
+
+    asyncio.run(main())
+    assert (out / "doc.txt").read_bytes() == TEXT
+    assert [path.name for path in out.iterdir()] == ["doc.txt"]
+
+
+def test_sharded_file_with_lost_segment(tmp_path):
+    (tmp_path / "doc.txt").write_bytes(TEXT)
+    segments, parts = cut(tmp_path / "doc.txt", 2)
+
+    async def main():
+        async with FakeStorage({id2scrap(1, 0): parts[0]}) as first, FakeStorage({}) as second:
+            with pytest.raises(FileNotFoundError):
+                await get_sharded(placement(segments, [[first], [first, second]]), 1, "doc.txt", str(tmp_path), 2)
+            await close_connections()
+
+    asyncio.run(main())
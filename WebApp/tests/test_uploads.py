@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+import storage_communication
+from conftest import FakeStorage
+from storage_communication import add_file, close_connections, uploaded
+
+STORAGES = [{"host": "localhost", "port": port} for port in (1, 2, 3)]
+
+
+async def upload(storage: dict, status: str, delay: float) -> dict[str, str]:
+    await asyncio.sleep(delay)
+    return {f"{storage['host']}:{storage['port']}": status}
+
+
+def statuses(quorum: int, *uploads: tuple[str, float]) -> dict[str, str]:
+    async def main():
+        tasks = [asyncio.create_task(upload(s, status, delay)) for s, (status, delay) in zip(STORAGES, uploads)]
+        return await uploaded(STORAGES, tasks, quorum)
+
+    return asyncio.run(main())
+
+
+def test_all_uploads_awaited_without_quorum():
+    assert statuses(0, ("OK", 0), ("Fail", 0), ("OK", 0.05)) == \
+        {"localhost:1": "OK", "localhost:2": "Fail", "localhost:3": "OK"}
+
+
+def test_slow_uploads_pending_once_quorum_reached():
+    assert statuses(2, ("OK", 0), ("OK", 0.01), ("OK", 10)) == \
+        {"localhost:1": "OK", "localhost:2": "OK", "localhost:3": "Pending"}
+
+
+def test_failed_uploads_do_not_count_for_quorum():
+    assert statuses(2, ("Fail", 0), ("OK", 0.01), ("OK", 0.05)) == \
+        {"localhost:1": "Fail", "localhost:2": "OK", "localhost:3": "OK"}
+
+
+def test_quorum_not_reached():
+    assert statuses(2, ("Fail", 0), ("OK", 0), ("Fail", 0)) == \
+        {"localhost:1": "Fail", "localhost:2": "OK", "localhost:3": "Fail"}
+
+
+@pytest.mark.parametrize("exception", [ConnectionResetError, BrokenPipeError])
+def test_upload_to_storage_that_went_down_fails(tmp_path, monkeypatch, exception):
+    (tmp_path / "doc.txt").write_bytes(b"text\n" * 1000)
+
+    async def drain(self):
+        # The storage asked for the chunks, then went down
+        raise exception()
+
+    monkeypatch.setattr(storage_communication.FrameWriter, "drain", drain)
+
+    async def main():
+        async with FakeStorage() as fake:
+            status = await add_file(fake.storage, 1, "doc.txt", str(tmp_path))
+            await close_connections()
+            return status, fake.storage
+
+    status, storage = asyncio.run(main())
+    assert status == {f"{storage['host']}:{storage['port']}": "Fail"}
+
+
+def test_upload_to_unreachable_storage_fails(tmp_path):
+    (tmp_path / "doc.txt").write_bytes(b"text\n")
+
+    async def main():
+        server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+        return await add_file({"host": "127.0.0.1", "port": port}, 1, "doc.txt", str(tmp_path))
+
+    assert list(asyncio.run(main()).values()) == ["Fail"]